@@ -0,0 +1,295 @@
+"""
+Classroom load test for RapidFire against a local mock OpenAI server and SMTP sink.
+
+Each simulated student drives main.py through Streamlit's AppTest, from the sign-up form
+through every Module 1 round, a Module 2 brainstorm and the Module 3 report email. No real
+OpenAI calls or emails are made. The run reports:
+
+- rerun latency percentiles, split into reruns that called the LLM and reruns that did not
+- time spent waiting on the (mock) LLM, and how many requests were rate limited
+- memory retained per session
+- throughput in completed sessions and interactions per minute
+
+Requires streamlit>=1.33, whose AppTest handles reruns (see benchmarks/requirements.txt).
+
+Usage:
+    python benchmarks/load_test.py --students 30 --concurrency 10 --ttft 0.5 --rate-limit-fraction 0.05
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from os.path import abspath, dirname, join
+
+import yaml
+
+from mock_openai import MockOpenAI, TOPIC_TRIGGER, start_mock_openai
+from smtp_sink import SMTPSink, start_smtp_sink
+
+REPO_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+STUDENT_FORM = {
+    "First Name*": "Ada",
+    "Last Name*": "Student",
+    "Email*": "ada@example.com",
+    "Zip Code*": "94110",
+    "Grade*": "12",
+    "School*": "Mission High",
+    "Counselor’s Name*": "Ms. Counselor",
+    "Counselor's Email*": "counselor@example.com",
+    "Counselor's Calendly Username*": "counselor",
+}
+
+BRAINSTORM_TURNS = [
+    "I'm not sure, maybe something about my family?",
+    "My grandmother taught me to bake bread every Sunday.",
+    f"Yes, {TOPIC_TRIGGER}.",
+]
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Student:
+    """
+    One simulated student session. Every AppTest run is timed and tagged with whether it called the LLM.
+
+    LLM calls are attributed to the student through the app's token ledger, which counts each session's
+    tokens, so other students' concurrent requests do not count. Background calls of the student's own
+    session (prefetching, summaries, report drafts) that finish during a rerun do count.
+    """
+
+    def __init__(self, app_test_cls, ledger, timeout):
+        self.at = app_test_cls.from_file(join(REPO_DIR, "main.py"), default_timeout=timeout)
+        self.ledger = ledger
+        self.reruns = []  # (seconds, called_llm)
+
+    def tokens_used(self):
+        try:
+            session_token = self.at.session_state["session_token"]
+        except KeyError:
+            return 0  # before the first run
+        return self.ledger.usage(session_token)[0]
+
+    def run(self, action=None):
+        before = self.tokens_used()
+        started = time.perf_counter()
+        (action or self.at).run()
+        seconds = time.perf_counter() - started
+        self.reruns.append((seconds, self.tokens_used() > before))
+        if self.at.exception:
+            raise RuntimeError(f"App raised: {self.at.exception[0].message}")
+
+    def button(self, label=None, key=None):
+        for button in self.at.button:
+            if (key is not None and button.key == key) or (label is not None and button.label.startswith(label)):
+                return button
+        raise LookupError(f"No button {label or key!r} on the page")
+
+    def go_to(self, page):
+        self.run(self.at.sidebar.selectbox[0].select(page))
+
+    def complete_session(self, num_rounds):
+        self.run()
+        for widget in list(self.at.text_input):
+            if widget.label in STUDENT_FORM:
+                widget.input(STUDENT_FORM[widget.label])
+        self.run()
+        self.run(self.button("Start the Process").click())
+
+        for _ in range(num_rounds):
+            self.run(self.button("Generate").click())
+            self.run(self.button(key="rate_4").click())
+
+        self.go_to("Module 2: Brainstorm")
+        for turn in BRAINSTORM_TURNS:
+            self.run(self.at.chat_input[0].set_value(turn))
+        self.run(self.button("Generate Report for Counselor").click())
+
+        self.go_to("Module 3: Statement Starter Report")
+        self.run(self.button("Send Statement Starter Report").click())
+
+
+def show_only_the_last_run():
+    """
+    Make AppTest's element tree hold only what the last script run drew, as the browser does. A run that
+    ends in st.experimental_rerun otherwise leaves the elements of the run before it in the tree, and
+    widgets among them that no longer exist make the next interaction fail.
+    """
+    from streamlit.runtime.scriptrunner import ScriptRunnerEvent
+    from streamlit.testing.v1.local_script_runner import LocalScriptRunner
+
+    init = LocalScriptRunner.__init__
+
+    def __init__(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+
+        def on_event(sender, event, **kwargs):
+            if event == ScriptRunnerEvent.SCRIPT_STARTED:
+                self.forward_msg_queue.clear()
+        self.on_event.connect(on_event, weak=False)
+
+    LocalScriptRunner.__init__ = __init__
+
+
+def share_app_test_globals(secrets):
+    """
+    Let students run at the same time. Each AppTest run installs its own mock Runtime, st.secrets and
+    "global.appTest" config option and removes them when it ends, which pulls them from under the other
+    students' runs: a script that then finishes cannot reach the Runtime and never reports completion, and
+    widgets drawn meanwhile are not registered with the tester. Install them once for the whole test instead.
+    Runs also share one script cache, as sessions on a server do, so main.py is compiled once rather than
+    on every run; compiling it on several threads at once can fail on Python 3.11.
+    """
+    from unittest.mock import MagicMock
+
+    import streamlit as st
+    from streamlit import config
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+    from streamlit.runtime.secrets import Secrets
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import app_test, local_script_runner
+
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime._instance = runtime
+    # AppTest's per-run installs now land on this subclass instead of the Runtime the app uses.
+    app_test.Runtime = type("PerRunRuntime", (Runtime,), {})
+
+    script_cache = ScriptCache()
+    local_script_runner.ScriptCache = lambda: script_cache
+
+    st.secrets = Secrets([])
+    st.secrets._secrets = secrets
+    # AppTest still patches the option per run, but restoring it now leaves it on.
+    config.set_option("global.appTest", True)
+
+
+def write_settings(directory, mock_server, smtp_server):
+    with open(join(REPO_DIR, "settings.yaml")) as file:
+        settings = yaml.safe_load(file)
+    settings.update({
+        "openai_api_base": f"http://127.0.0.1:{mock_server.server_port}/v1",
+        "smtp_host": "127.0.0.1",
+        "smtp_port": smtp_server.server_address[1],
+        "smtp_ssl": False,
+        "essay_cache_path": join(directory, "essay_cache.sqlite3"),
+        "outbox_path": join(directory, "outbox.sqlite3"),
+        "session_store_path": join(directory, "sessions.sqlite3"),
+        "token_ledger_path": join(directory, "token_ledger.sqlite3"),
+        "essay_corpus_path": join(directory, "essay_corpus.jsonl"),
+        "token_budget_per_day": 0,  # simulated students would otherwise be degraded by each other
+        "metrics_port": 0,
+        "metrics_log_path": join(directory, "metrics.jsonl"),
+    })
+    path = join(directory, "settings.yaml")
+    with open(path, "w") as file:
+        yaml.safe_dump(settings, file)
+    return path, settings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=10, help="Number of simulated student sessions.")
+    parser.add_argument("--concurrency", type=int, default=5, help="Sessions running at the same time.")
+    parser.add_argument("--ttft", type=float, default=0.5, help="Mock seconds before the first token.")
+    parser.add_argument("--tokens-per-second", type=float, default=100.0, help="Mock generation speed.")
+    parser.add_argument("--completion-tokens", type=int, default=300, help="Mock words per response.")
+    parser.add_argument("--rate-limit-fraction", type=float, default=0.0, help="Fraction of mock requests answered with 429.")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds allowed for a single rerun.")
+    parser.add_argument("--json", default=None, help="Also write the report to this JSON file.")
+    args = parser.parse_args()
+
+    try:
+        from streamlit.testing.v1 import AppTest
+    except ImportError:
+        parser.error("streamlit.testing is not available; install benchmarks/requirements.txt")
+    show_only_the_last_run()
+    share_app_test_globals({"openai_secret_key": "sk-mock", "email_password": "mock-password"})
+    from token_ledger import TokenLedger
+
+    mock = MockOpenAI(args.ttft, args.tokens_per_second, args.completion_tokens, args.rate_limit_fraction)
+    mock_server = start_mock_openai(mock)
+    sink = SMTPSink()
+    smtp_server = start_smtp_sink(sink)
+
+    with tempfile.TemporaryDirectory() as directory:
+        settings_path, settings = write_settings(directory, mock_server, smtp_server)
+        os.environ["RAPIDFIRE_SETTINGS"] = settings_path
+        ledger = TokenLedger(settings["token_ledger_path"])
+
+        students = []
+        failures = []
+        lock = threading.Lock()
+
+        def simulate():
+            student = Student(AppTest, ledger, args.timeout)
+            with lock:
+                students.append(student)
+            try:
+                student.complete_session(settings['num_rounds'])
+            except Exception as e:
+                with lock:
+                    failures.append(repr(e))
+
+        tracemalloc.start()
+        memory_before, _ = tracemalloc.get_traced_memory()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            for _ in range(args.students):
+                executor.submit(simulate)
+        elapsed = time.perf_counter() - started
+        delivered = sink.wait_for(args.students - len(failures), timeout=60)
+        memory_after, memory_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    llm_reruns = [seconds for student in students for seconds, called_llm in student.reruns if called_llm]
+    plain_reruns = [seconds for student in students for seconds, called_llm in student.reruns if not called_llm]
+    interactions = sum(len(student.reruns) for student in students)
+    mock_stats = mock.stats()
+    report = {
+        "students": args.students,
+        "completed": args.students - len(failures),
+        "failures": failures,
+        "elapsed_seconds": elapsed,
+        "sessions_per_minute": (args.students - len(failures)) / elapsed * 60,
+        "interactions_per_minute": interactions / elapsed * 60,
+        "rerun_ms": {name: {"count": len(values),
+                            "p50": percentile(values, 0.5) * 1000,
+                            "p95": percentile(values, 0.95) * 1000,
+                            "p99": percentile(values, 0.99) * 1000,
+                            "mean": statistics.fmean(values) * 1000 if values else float("nan")}
+                     for name, values in (("without_llm", plain_reruns), ("with_llm", llm_reruns))},
+        "llm_requests": mock_stats["requests"],
+        "llm_rate_limited": mock_stats["rate_limited"],
+        "llm_wait_seconds_per_session": mock_stats["busy_seconds"] / max(1, args.students),
+        "memory_per_session_kib": (memory_after - memory_before) / max(1, len(students)) / 1024,
+        "memory_peak_mib": memory_peak / 2 ** 20,
+        "emails_delivered": len(sink.messages),
+        "emails_all_delivered": delivered,
+        "smtp_connections": sink.connections,
+    }
+
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
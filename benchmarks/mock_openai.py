@@ -0,0 +1,192 @@
+"""
+Local OpenAI-compatible chat completions server for benchmarks.
+
+Responses are canned text produced at a configurable latency and token rate, and a fraction
+of requests can be answered with 429 to exercise rate-limit handling. Point the app at it
+with `openai_api_base: http://127.0.0.1:<port>/v1` in the settings file.
+
+Usage:
+    python benchmarks/mock_openai.py --port 8765 --ttft 0.5 --tokens-per-second 50 --rate-limit-fraction 0.05
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ("I remember the summer my grandmother taught me to bake bread in her small kitchen while the radio "
+         "played songs I did not yet understand and every fold of the dough felt like a lesson about patience").split()
+
+# A student message containing this phrase makes the mock agree on a topic, unlocking the report
+TOPIC_TRIGGER = "let's write about that"
+
+
+class MockOpenAI:
+    """
+    Configuration and statistics for the mock server.
+    """
+
+    def __init__(self, ttft=0.5, tokens_per_second=50.0, completion_tokens=300, rate_limit_fraction=0.0,
+                 retry_after=1.0, seed=None):
+        """
+        Parameters:
+        - ttft (float): Seconds before the first token (or the whole response when not streaming) starts.
+        - tokens_per_second (float): Generation speed after the first token.
+        - completion_tokens (int): Number of words in each response.
+        - rate_limit_fraction (float): Fraction of requests answered with 429.
+        - retry_after (float): Retry-After header sent with 429 responses.
+        """
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.rate_limit_fraction = rate_limit_fraction
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+        self.busy_seconds = 0.0
+
+    def should_rate_limit(self):
+        with self._lock:
+            self.requests += 1
+            limited = self._random.random() < self.rate_limit_fraction
+            if limited:
+                self.rate_limited += 1
+            return limited
+
+    def record(self, seconds):
+        with self._lock:
+            self.busy_seconds += seconds
+
+    def completion(self, last_message, prompt_text=""):
+        if TOPIC_TRIGGER in last_message:
+            return "[TOPIC IDENTIFIED] Bread, patience and my grandmother's kitchen"
+        # Different prompts get different text, as the app shows e.g. the strong and weak essays side by side
+        words = random.Random(zlib.crc32(prompt_text.encode()))
+        return " ".join(words.choice(WORDS) for _ in range(self.completion_tokens))
+
+    def stats(self):
+        with self._lock:
+            return {"requests": self.requests, "rate_limited": self.rate_limited, "busy_seconds": self.busy_seconds}
+
+
+def make_handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, body, headers=None):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+                return
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if mock.should_rate_limit():
+                self._send_json(429, {"error": {"message": "Rate limit reached (mock).", "type": "requests",
+                                                "code": "rate_limit_exceeded"}},
+                                headers={"Retry-After": str(mock.retry_after)})
+                return
+
+            started = time.monotonic()
+            prompt_text = "\n".join(message.get("content", "") for message in request.get("messages", []))
+            # The student's latest chat turn is the last user message
+            user_messages = [message.get("content", "") for message in request.get("messages", [])
+                             if message.get("role") == "user"]
+            words = mock.completion(user_messages[-1] if user_messages else "", prompt_text).split(" ")
+            model = request.get("model", "gpt-4")
+            time.sleep(mock.ttft)
+            if request.get("stream"):
+                self._stream(model, words)
+            else:
+                time.sleep(len(words) / mock.tokens_per_second)
+                self._send_json(200, {
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)},
+                                 "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": len(prompt_text) // 4, "completion_tokens": len(words),
+                              "total_tokens": len(prompt_text) // 4 + len(words)},
+                })
+            mock.record(time.monotonic() - started)
+
+        def _stream(self, model, words):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            def send_event(payload):
+                data = f"data: {payload}\n\n".encode()
+                self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+            try:
+                for i, word in enumerate(words):
+                    delta = {"content": word if i == 0 else " " + word}
+                    if i == 0:
+                        delta["role"] = "assistant"
+                    send_event(json.dumps({"id": "chatcmpl-mock", "object": "chat.completion.chunk",
+                                           "created": int(time.time()), "model": model,
+                                           "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}))
+                    time.sleep(1 / mock.tokens_per_second)
+                send_event(json.dumps({"id": "chatcmpl-mock", "object": "chat.completion.chunk",
+                                       "created": int(time.time()), "model": model,
+                                       "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}))
+                send_event("[DONE]")
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # the client stopped reading, e.g. the gateway hedged or abandoned the request
+
+    return Handler
+
+
+def start_mock_openai(mock, host="127.0.0.1", port=0):
+    """
+    Serve the mock on a background thread.
+
+    Returns:
+    - ThreadingHTTPServer: The running server. Its API base is http://<host>:<server.server_port>/v1.
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(mock))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-openai", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--ttft", type=float, default=0.5, help="Seconds before the first token.")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--completion-tokens", type=int, default=300)
+    parser.add_argument("--rate-limit-fraction", type=float, default=0.0, help="Fraction of requests answered with 429.")
+    args = parser.parse_args()
+
+    mock = MockOpenAI(args.ttft, args.tokens_per_second, args.completion_tokens, args.rate_limit_fraction)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(mock))
+    print(f"Mock OpenAI API at http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(mock.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Micro-benchmark of report PDF rendering.
+
+Compares, for a typical Statement Starter Report and a very long one:
+
+- legacy: the previous create_pdf (a new FPDF, the whole text through one multi_cell)
+- cold: report_pdf.ReportRenderer with an empty cache (markdown-aware layout)
+- cached: the same renderer rendering an unchanged report again
+
+and reports the median render time, peak traced memory and PDF size for each.
+
+Usage:
+    python benchmarks/pdf_render.py --repeat 20 --long-factor 40
+"""
+import argparse
+import io
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+import warnings
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from fpdf import FPDF
+
+from report_pdf import ReportRenderer, to_latin1
+
+TYPICAL_REPORT = """\
+# Statement Starter Report
+
+- **Student Full Name:** Ada Student | **Email:** ada@example.com | **Zip Code:** 94110
+- **School:** Mission High | **Grade:** 12 | **Counselor:** Ms. Counselor (counselor@example.com)
+- **Top Three Schools:** UC Berkeley, Stanford, UCLA
+
+## Summary of the Conversation
+
+Ada started unsure about what to write, mentioning her family as a possible theme. When asked \
+about specific memories, she described baking bread every Sunday with her grandmother — a ritual \
+that taught her patience, attention to detail and the value of showing up for the people she loves. \
+She lit up when talking about the “small kitchen” and the songs on the radio.
+
+## Possible Essay Outline
+
+1. **Opening image:** The smell of dough on a Sunday morning and the radio playing.
+2. **The ritual:** What baking with her grandmother looked like, step by step.
+   - The first loaf that failed, and what her grandmother said.
+   - Learning to wait for the dough to rise.
+3. **The lesson:** Patience as a skill she now applies to school and to her robotics team.
+4. **Looking forward:** How she wants to bring the same care to her college community.
+
+## Suggested Questions for the Counselor
+
+- What did your grandmother say the day your first loaf failed?
+- Where else in your life do you “wait for the dough to rise”?
+- How has this ritual changed as you have gotten older?
+
+---
+
+*Prepared automatically from the Module 2 brainstorm.*
+"""
+
+
+def legacy_create_pdf(text):
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("Arial", size=12)
+    pdf.multi_cell(0, 10, txt=text)
+    pdf_buffer = io.BytesIO()
+    pdf.output(pdf_buffer, "F")
+    pdf_buffer.seek(0)
+    return pdf_buffer.getvalue()
+
+
+def measure(render, text, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        pdf_bytes = render(text)
+        times.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    render(text)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"median_ms": statistics.median(times) * 1000, "peak_kib": peak / 1024, "pdf_kib": len(pdf_bytes) / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20, help="Renders per measurement.")
+    parser.add_argument("--long-factor", type=int, default=40, help="How many typical reports make up the long one.")
+    parser.add_argument("--json", default=None, help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")  # fpdf2 warns about substituting Arial on every legacy render
+
+    reports = {
+        "typical": TYPICAL_REPORT,
+        "long": "\n".join(TYPICAL_REPORT.replace("# Statement", f"# Part {i}: Statement") for i in range(args.long_factor)),
+    }
+    results = {}
+    for name, text in reports.items():
+        renderer = ReportRenderer()
+
+        def cold(text):
+            renderer.clear()
+            return renderer.render(text)
+
+        results[name] = {
+            "words": len(text.split()),
+            # The legacy renderer cannot encode typographic punctuation, so it gets Latin-1 text
+            "legacy": measure(legacy_create_pdf, to_latin1(text), args.repeat),
+            "cold": measure(cold, text, args.repeat),
+            "cached": measure(renderer.render, text, args.repeat),
+        }
+
+    for name, result in results.items():
+        print(f"{name} report ({result['words']} words)")
+        for variant in ("legacy", "cold", "cached"):
+            stats = result[variant]
+            print(f"  {variant:<7} {stats['median_ms']:9.2f} ms  peak {stats['peak_kib']:9.1f} KiB  pdf {stats['pdf_kib']:7.1f} KiB")
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Local SMTP server that accepts and stores every message, for benchmarks and manual testing.
+
+Point the app at it with `smtp_host: 127.0.0.1`, `smtp_port: <port>` and `smtp_ssl: false`
+in the settings file. Logins are accepted without checking credentials.
+
+Usage:
+    python benchmarks/smtp_sink.py --port 8025
+"""
+import argparse
+import socketserver
+import threading
+from email import message_from_bytes, policy
+
+
+class SMTPSink:
+    """
+    Messages received by the sink.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._received = threading.Condition(self._lock)
+
+    def add(self, raw_message):
+        with self._lock:
+            self.messages.append(message_from_bytes(raw_message, policy=policy.SMTP))
+            self._received.notify_all()
+
+    def connected(self):
+        with self._lock:
+            self.connections += 1
+
+    def wait_for(self, count, timeout=None):
+        """
+        Wait until at least `count` messages have been received.
+
+        Returns:
+        - bool: Whether the messages arrived before the timeout.
+        """
+        with self._lock:
+            return self._received.wait_for(lambda: len(self.messages) >= count, timeout)
+
+
+def make_handler(sink):
+    class Handler(socketserver.StreamRequestHandler):
+        def reply(self, line):
+            self.wfile.write(line.encode() + b"\r\n")
+
+        def handle(self):
+            sink.connected()
+            self.reply("220 smtp-sink ready")
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                command = line.decode(errors="replace").strip()
+                verb = command.split(" ", 1)[0].upper()
+                if verb == "EHLO":
+                    self.reply("250-smtp-sink")
+                    self.reply("250-AUTH PLAIN LOGIN")
+                    self.reply("250 8BITMIME")
+                elif verb == "HELO":
+                    self.reply("250 smtp-sink")
+                elif verb == "AUTH":
+                    self.reply("235 Authentication successful")
+                elif verb == "DATA":
+                    self.reply("354 End data with <CR><LF>.<CR><LF>")
+                    lines = []
+                    for data_line in iter(self.rfile.readline, b""):
+                        if data_line in (b".\r\n", b".\n"):
+                            break
+                        # Undo dot-stuffing
+                        lines.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                    sink.add(b"".join(lines))
+                    self.reply("250 OK: queued")
+                elif verb == "QUIT":
+                    self.reply("221 Bye")
+                    return
+                elif verb in ("MAIL", "RCPT", "RSET", "NOOP"):
+                    self.reply("250 OK")
+                else:
+                    self.reply("502 Command not implemented")
+
+    return Handler
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start_smtp_sink(sink, host="127.0.0.1", port=0):
+    """
+    Serve the sink on a background thread.
+
+    Returns:
+    - socketserver.ThreadingTCPServer: The running server, listening on server.server_address.
+    """
+    server = _Server((host, port), make_handler(sink))
+    threading.Thread(target=server.serve_forever, name="smtp-sink", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8025)
+    args = parser.parse_args()
+
+    sink = SMTPSink()
+    server = _Server((args.host, args.port), make_handler(sink))
+    print(f"SMTP sink listening on {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"Received {len(sink.messages)} messages over {sink.connections} connections")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Cold-start benchmark for RapidFire.
+
+Each measurement runs in a fresh Python process, like a container waking up:
+
+- import: time to import main.py's dependencies (python -X importtime), the slowest modules,
+  and which of the heavy, lazily loaded ones (openai, fpdf) were imported anyway
+- first paint: time from process start until the first run of main.py has finished in
+  Streamlit's AppTest, i.e. until the first page is complete (requires streamlit>=1.28)
+
+With --import-budget-ms / --paint-budget-ms the script exits with status 1 when the median
+exceeds the budget, so it can guard the cold-start budget in CI.
+
+Usage:
+    python benchmarks/startup.py --runs 5 --paint-budget-ms 3000
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from os.path import abspath, dirname, join
+
+import yaml
+
+REPO_DIR = dirname(dirname(abspath(__file__)))
+
+# Modules main.py imports at the top
+APP_MODULES = ["streamlit", "resources", "utils", "prefetch", "essay_cache", "essay_corpus", "memory", "report_draft",
+               "outbox", "metrics", "session_store", "scheduler", "digest", "report_pdf", "token_ledger"]
+# Slow to import and only needed once an LLM is called or a report is rendered
+LAZY_MODULES = ["openai", "aiohttp", "requests", "fpdf"]
+
+IMPORT_SCRIPT = f"""
+import sys, time
+started = time.perf_counter()
+for name in {APP_MODULES!r}:
+    __import__(name)
+print(round((time.perf_counter() - started) * 1000, 2))
+print(",".join(name for name in {LAZY_MODULES!r} if name in sys.modules))
+"""
+
+PAINT_SCRIPT = """
+import sys, time
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(sys.argv[1], default_timeout=120)
+at.secrets["openai_secret_key"] = "sk-startup-benchmark"
+at.secrets["email_password"] = ""
+at.run()
+if at.exception:
+    raise SystemExit(at.exception[0].message)
+print(round((time.perf_counter() - started) * 1000, 2))
+"""
+
+
+def run_python(args, env):
+    result = subprocess.run([sys.executable, *args], cwd=REPO_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed")
+    return result
+
+
+def slowest_imports(env, count):
+    # Cumulative import time of each module, from python -X importtime
+    result = run_python(["-X", "importtime", "-c", IMPORT_SCRIPT], env)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        try:
+            modules[name.strip()] = max(modules.get(name.strip(), 0), int(cumulative) / 1000)
+        except ValueError:
+            continue  # header line
+    return dict(sorted(modules.items(), key=lambda item: -item[1])[:count])
+
+
+def write_settings(directory):
+    with open(join(REPO_DIR, "settings.yaml")) as file:
+        settings = yaml.safe_load(file)
+    settings.update({
+        "essay_cache_path": join(directory, "essay_cache.sqlite3"),
+        "outbox_path": join(directory, "outbox.sqlite3"),
+        "session_store_path": join(directory, "sessions.sqlite3"),
+        "digest_path": join(directory, "digest.sqlite3"),
+        "token_ledger_path": join(directory, "token_ledger.sqlite3"),
+        "essay_corpus_path": join(directory, "essay_corpus.jsonl"),
+        "metrics_port": 0,
+        "metrics_log_path": None,
+        "llm_client": "stub",
+        "warm_up_after_first_paint": False,  # would compete with the measurement
+    })
+    path = join(directory, "settings.yaml")
+    with open(path, "w") as file:
+        yaml.safe_dump(settings, file)
+    return path
+
+
+def summarize(values):
+    return {"median": statistics.median(values), "min": min(values), "max": max(values)} if values else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Fresh processes per measurement.")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest imports to list.")
+    parser.add_argument("--skip-paint", action="store_true", help="Only measure imports.")
+    parser.add_argument("--import-budget-ms", type=float, default=None)
+    parser.add_argument("--paint-budget-ms", type=float, default=None)
+    parser.add_argument("--json", default=None, help="Also write the report to this JSON file.")
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=REPO_DIR, PYTHONDONTWRITEBYTECODE="")
+    import_ms, eager = [], set()
+    for _ in range(args.runs):
+        lines = run_python(["-c", IMPORT_SCRIPT], env).stdout.splitlines()
+        import_ms.append(float(lines[0]))
+        eager.update(name for name in (lines[1] if len(lines) > 1 else "").split(",") if name)
+
+    report = {
+        "import_ms": summarize(import_ms),
+        "eagerly_imported_lazy_modules": sorted(eager),
+        "slowest_imports_ms": slowest_imports(env, args.top),
+        "first_paint_ms": None,
+    }
+
+    if not args.skip_paint:
+        with tempfile.TemporaryDirectory() as directory:
+            env["RAPIDFIRE_SETTINGS"] = write_settings(directory)
+            paint_ms = [float(run_python(["-c", PAINT_SCRIPT, join(REPO_DIR, "main.py")], env).stdout.split()[-1])
+                        for _ in range(args.runs)]
+        report["first_paint_ms"] = summarize(paint_ms)
+
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+
+    over_budget = []
+    if args.import_budget_ms is not None and report["import_ms"]["median"] > args.import_budget_ms:
+        over_budget.append(f"import {report['import_ms']['median']:.0f} ms > {args.import_budget_ms:.0f} ms")
+    if args.paint_budget_ms is not None and report["first_paint_ms"] \
+            and report["first_paint_ms"]["median"] > args.paint_budget_ms:
+        over_budget.append(f"first paint {report['first_paint_ms']['median']:.0f} ms > {args.paint_budget_ms:.0f} ms")
+    if over_budget:
+        sys.exit("Cold-start budget exceeded: " + "; ".join(over_budget))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import io
+import os
+import sqlite3
+import threading
+import time
+import zipfile
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from email.utils import make_msgid
+
+from outbox import DeliveryStatus
+from utils import create_digest_pdf
+
+
+class ReportDigest:
+    """
+    Counselor digest: collects Statement Starter Reports and sends each counselor one email a day.
+
+    Reports are stored in a local SQLite queue when the student sends them. Once a day, at
+    `send_hour` (server local time), a background job groups every report added before that
+    time by counselor, renders one attachment per counselor (a merged PDF with an index page,
+    or a zip with an index and the individual PDFs) and queues a single email per counselor
+    in the EmailOutbox. Reports missed while the app was down are sent when it starts.
+    """
+
+    def __init__(self, path, outbox, sender_email, send_hour=7, attachment="pdf", max_reports_per_email=100,
+                 poll_interval=60.0):
+        """
+        Parameters:
+        - path (str): Path to the SQLite queue file. It is created if it does not exist.
+        - outbox (EmailOutbox): Outbox that delivers the digest emails.
+        - sender_email (str): From address of the digests.
+        - send_hour (int): Hour of the day (0-23, server local time) at which digests are sent.
+        - attachment (str): "pdf" for one merged PDF, "zip" for a zip of the individual PDFs.
+        - max_reports_per_email (int): Larger digests are split over several emails.
+        - poll_interval (float): Maximum seconds between checks for due digests.
+        """
+        if attachment not in ("pdf", "zip"):
+            raise ValueError(f"Unknown digest attachment {attachment!r}, expected 'pdf' or 'zip'")
+        self.outbox = outbox
+        self.sender_email = sender_email
+        self.send_hour = send_hour
+        self.attachment = attachment
+        self.max_reports_per_email = max_reports_per_email
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._worker = None
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS digest_reports (
+                id INTEGER PRIMARY KEY,
+                counselor_email TEXT NOT NULL,
+                counselor_name TEXT NOT NULL,
+                student_name TEXT NOT NULL,
+                report TEXT NOT NULL,
+                pdf BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                email_id INTEGER
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS digest_reports_pending ON digest_reports (email_id, created_at)")
+        self._conn.commit()
+
+    def add(self, counselor_email, counselor_name, student_name, report, pdf):
+        """
+        Add a report to its counselor's next digest.
+
+        Parameters:
+        - counselor_email (str), counselor_name (str): The counselor the report is for.
+        - student_name (str): Shown in the index and used to name the PDF.
+        - report (str): Report text, rendered into the merged PDF.
+        - pdf (bytes): The student's report PDF, attached as-is in zip digests.
+
+        Returns:
+        - int: Id of the report, for use with `status`.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO digest_reports (counselor_email, counselor_name, student_name, report, pdf, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (counselor_email, counselor_name, student_name, report, pdf, time.time())
+            )
+            self._conn.commit()
+        return cursor.lastrowid
+
+    def status(self, report_id):
+        """
+        Return the delivery status of a report.
+
+        Returns:
+        - DeliveryStatus: "scheduled", with the datetime of the next digest as send_at, while it waits for
+          the digest, then the status of the digest email in the outbox.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT email_id FROM digest_reports WHERE id = ?", (report_id,)).fetchone()
+        if row is None:
+            return DeliveryStatus("unknown", None, None)
+        if row[0] is None:
+            return DeliveryStatus("scheduled", None, self.next_send_time())
+        return self.outbox.status(row[0])
+
+    def _last_send_time(self, now):
+        slot = datetime.fromtimestamp(now).replace(hour=self.send_hour, minute=0, second=0, microsecond=0)
+        if slot.timestamp() > now:
+            slot -= timedelta(days=1)
+        return slot
+
+    def next_send_time(self, now=None):
+        """Return the datetime at which the next digests are sent."""
+        return self._last_send_time(time.time() if now is None else now) + timedelta(days=1)
+
+    def send_due(self, now=None):
+        """
+        Queue one digest email per counselor for every report added before the last send time.
+
+        Returns:
+        - int: Number of emails queued.
+        """
+        cutoff = self._last_send_time(time.time() if now is None else now).timestamp()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, counselor_email, counselor_name, student_name, report, pdf, created_at FROM digest_reports "
+                "WHERE email_id IS NULL AND created_at < ? ORDER BY counselor_email, created_at",
+                (cutoff,)
+            ).fetchall()
+
+        groups = {}
+        for row in rows:
+            report = dict(zip(("id", "counselor_email", "counselor_name", "student_name", "report", "pdf", "created_at"), row))
+            groups.setdefault(report["counselor_email"], []).append(report)
+
+        queued = 0
+        for counselor_email, reports in groups.items():
+            for start in range(0, len(reports), self.max_reports_per_email):
+                batch = reports[start:start + self.max_reports_per_email]
+                email_id = self.outbox.enqueue(self._build_email(counselor_email, batch))
+                with self._lock:
+                    self._conn.executemany("UPDATE digest_reports SET email_id = ? WHERE id = ?",
+                                           [(email_id, report["id"]) for report in batch])
+                    self._conn.commit()
+                queued += 1
+        return queued
+
+    def _build_email(self, counselor_email, reports):
+        counselor_name = reports[0]["counselor_name"]
+        titles = [f"{report['student_name']} (sent {datetime.fromtimestamp(report['created_at']):%b %d, %Y %H:%M})"
+                  for report in reports]
+        index_text = "\n".join(f"{i}. {title}" for i, title in enumerate(titles, 1))
+
+        message = EmailMessage()
+        message["From"] = self.sender_email
+        message["To"] = counselor_email
+        message["Subject"] = f"Statement Starter Reports: {len(reports)} new student report{'s' if len(reports) != 1 else ''}"
+        message["Message-ID"] = make_msgid()
+        message.set_content(
+            f"Hello {counselor_name},\n\n"
+            f"The following students sent you their Statement Starter Report since the last digest. "
+            f"Their reports are attached.\n\n{index_text}\n\nBest,\nStatement Starter Team"
+        )
+
+        date = datetime.now().strftime("%Y-%m-%d")
+        if self.attachment == "pdf":
+            pdf_buffer = create_digest_pdf(
+                f"Statement Starter Reports for {counselor_name}",
+                [(title, report["report"]) for title, report in zip(titles, reports)]
+            )
+            message.add_attachment(pdf_buffer.getvalue(), maintype="application", subtype="pdf",
+                                   filename=f"statement_starter_reports_{date}.pdf")
+        else:
+            zip_buffer = io.BytesIO()
+            with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr("index.txt", index_text + "\n")
+                for i, report in enumerate(reports, 1):
+                    archive.writestr(f"{i:03d}_{report['student_name']}_counseling_report.pdf", report["pdf"])
+            message.add_attachment(zip_buffer.getvalue(), maintype="application", subtype="zip",
+                                   filename=f"statement_starter_reports_{date}.zip")
+        return message
+
+    def start(self):
+        """Start the background job if it is not already running."""
+        if self._worker is None or not self._worker.is_alive():
+            self._stop.clear()
+            self._worker = threading.Thread(target=self._run, name="report-digest", daemon=True)
+            self._worker.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Stop the background job. Unsent reports stay queued."""
+        self._stop.set()
+        if self._worker is not None:
+            self._worker.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.send_due()
+            except Exception:
+                pass  # retried on the next check
+            until_next = self.next_send_time().timestamp() - time.time()
+            self._stop.wait(max(1.0, min(self.poll_interval, until_next)))
+
+
+def open_report_digest(settings, base_dir, outbox):
+    """
+    Open the counselor digest configured in settings.yaml and start its background job.
+
+    Parameters:
+    - settings (dict): Contents of settings.yaml.
+    - base_dir (str): Directory that a relative digest_path is resolved against.
+    - outbox (EmailOutbox): Outbox that delivers the digest emails.
+
+    Returns:
+    - ReportDigest: The running digest.
+    """
+    digest = ReportDigest(
+        os.path.join(base_dir, settings.get('digest_path', 'digest.sqlite3')),
+        outbox,
+        settings['sender_email'],
+        send_hour=settings.get('digest_send_hour', 7),
+        attachment=settings.get('digest_attachment', 'pdf'),
+        max_reports_per_email=settings.get('digest_max_reports_per_email', 100)
+    )
+    return digest.start()
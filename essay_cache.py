@@ -0,0 +1,148 @@
+import os
+import hashlib
+import random
+import sqlite3
+import threading
+import time
+
+from metrics import METRICS
+
+
+class EssayCache:
+    """
+    Disk-backed cache of Module 1 essays keyed by the rendered module_one_strong/module_one_weak prompt.
+
+    Several outputs ("variants") can be stored per prompt so students who make the same
+    selections still see different essays. Entries expire after a TTL and the least
+    recently used entries are evicted once the cache holds more than max_entries outputs.
+    The cache is shared by every session and process that opens the same file.
+    """
+
+    def __init__(self, path, max_entries=50000, ttl_seconds=30 * 24 * 3600, variants_per_prompt=3):
+        """
+        Parameters:
+        - path (str): Path to the SQLite database file. It is created if it does not exist.
+        - max_entries (int): Maximum number of stored outputs across all prompts.
+        - ttl_seconds (float): Age after which an output is no longer served. None disables expiry.
+        - variants_per_prompt (int): Maximum number of outputs stored for one prompt.
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.variants_per_prompt = variants_per_prompt
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS essays (
+                id INTEGER PRIMARY KEY,
+                prompt_key TEXT NOT NULL,
+                output TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS essays_prompt_key ON essays (prompt_key)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS essays_last_used ON essays (last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def _key(prompt):
+        # A ChatPrompt is keyed by its text, which is the same as the prompt rendered as one string
+        return hashlib.sha256(str(prompt).encode("utf-8")).hexdigest()
+
+    def _min_created_at(self, now):
+        return now - self.ttl_seconds if self.ttl_seconds else 0
+
+    def get(self, prompt):
+        """
+        Return a random stored variant for a prompt.
+
+        Parameters:
+        - prompt (str or ChatPrompt): Rendered Module 1 prompt.
+
+        Returns:
+        - str or None: A cached output, or None on a cache miss.
+        """
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, output FROM essays WHERE prompt_key = ? AND created_at >= ?",
+                (self._key(prompt), self._min_created_at(now))
+            ).fetchall()
+            if not rows:
+                METRICS.inc("essay_cache_requests", result="miss")
+                return None
+            row_id, output = random.choice(rows)
+            self._conn.execute("UPDATE essays SET last_used = ? WHERE id = ?", (now, row_id))
+            self._conn.commit()
+        METRICS.inc("essay_cache_requests", result="hit")
+        return output
+
+    def variant_count(self, prompt):
+        """
+        Return the number of unexpired variants stored for a prompt.
+        """
+        with self._lock:
+            (count,) = self._conn.execute(
+                "SELECT COUNT(*) FROM essays WHERE prompt_key = ? AND created_at >= ?",
+                (self._key(prompt), self._min_created_at(time.time()))
+            ).fetchone()
+        return count
+
+    def put(self, prompt, output):
+        """
+        Store a new variant for a prompt, replacing its oldest variant when the prompt is full,
+        then evict expired and least recently used outputs.
+
+        Parameters:
+        - prompt (str or ChatPrompt): Rendered Module 1 prompt.
+        - output (str): LLM output for the prompt.
+        """
+        key = self._key(prompt)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO essays (prompt_key, output, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, output, now, now)
+            )
+            self._conn.execute("""
+                DELETE FROM essays WHERE prompt_key = ? AND id NOT IN (
+                    SELECT id FROM essays WHERE prompt_key = ? ORDER BY created_at DESC LIMIT ?
+                )
+            """, (key, key, self.variants_per_prompt))
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        if self.ttl_seconds:
+            self._conn.execute("DELETE FROM essays WHERE created_at < ?", (self._min_created_at(now),))
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM essays").fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM essays WHERE id IN (SELECT id FROM essays ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def open_essay_cache(settings, base_dir):
+    """
+    Open the essay cache configured in settings.yaml.
+
+    Parameters:
+    - settings (dict): Contents of settings.yaml.
+    - base_dir (str): Directory that a relative essay_cache_path is resolved against.
+
+    Returns:
+    - EssayCache: The opened cache.
+    """
+    ttl_days = settings.get('essay_cache_ttl_days', 30)
+    return EssayCache(
+        os.path.join(base_dir, settings.get('essay_cache_path', 'essay_cache.sqlite3')),
+        max_entries=settings.get('essay_cache_max_entries', 50000),
+        ttl_seconds=ttl_days * 24 * 3600 if ttl_days else None,
+        variants_per_prompt=settings.get('essay_cache_variants', 3)
+    )
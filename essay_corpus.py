@@ -0,0 +1,260 @@
+"""
+Corpus of generated Module 1 essay pairs and the ratings students gave them.
+
+Usage:
+    python essay_corpus.py --export rated_pairs.jsonl --min-rating 4
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+
+from metrics import METRICS
+
+# What a student picks in Module 1; together they determine both essay prompts
+SELECTION_FIELDS = ("strong_attribute", "weak_attribute", "identity", "wildcard", "common_essay_prompt")
+
+
+class EssayCorpus:
+    """
+    Append-only JSONL corpus of Module 1 essay pairs with an in-memory index for sampling.
+
+    Every generated pair is appended as one line with its selection (attributes, identity,
+    wildcard and common prompt), and every rating as a small line referring to the pair by its
+    byte offset, which is its id. The index keeps only offsets and rating totals, never essay
+    text: for each selection, the list of pairs whose mean rating is at least `min_rating`, so
+    `sample` picks one in O(1) and reads just that line from disk. The index is saved next to
+    the corpus (`<path>.idx`) and on open only the lines appended since are read.
+
+    Writes are serialized with a lock; the corpus must only be written by one process.
+    """
+
+    def __init__(self, path, min_rating=4, min_ratings=1, save_index_every=100):
+        """
+        Parameters:
+        - path (str): Path to the JSONL file. It is created if it does not exist.
+        - min_rating (float): Mean rating a pair needs to be served by `sample`.
+        - min_ratings (int): Number of ratings a pair needs to be served by `sample`.
+        - save_index_every (int): Save the index after this many appended lines.
+        """
+        self.path = path
+        self.index_path = path + ".idx"
+        self.min_rating = min_rating
+        self.min_ratings = min_ratings
+        self.save_index_every = save_index_every
+        self._lock = threading.Lock()
+        self._pairs = {}  # pair id -> [selection key, line length, rating sum, rating count]
+        self._good = {}  # selection key -> ids of pairs that can be served
+        self._good_positions = {}  # pair id -> position in self._good[key]
+        self._unsaved = 0
+        self._file = open(path, "ab")
+        self._fd = os.open(path, os.O_RDONLY)
+        self._load()
+
+    @staticmethod
+    def _key(selection):
+        return "\x1f".join(selection[field] for field in SELECTION_FIELDS)
+
+    def _load(self):
+        indexed = 0
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path) as file:
+                    saved = json.load(file)
+                if saved["size"] <= os.path.getsize(self.path):
+                    indexed = saved["size"]
+                    self._pairs = {int(pair_id): entry for pair_id, entry in saved["pairs"].items()}
+            except (OSError, ValueError, KeyError):
+                self._pairs = {}  # rebuilt from the corpus below
+        with open(self.path, "rb") as file:
+            file.seek(indexed)
+            offset = indexed
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break  # partly written line, e.g. after a crash; overwritten by the next append
+                self._index(offset, json.loads(line), len(line))
+                offset += len(line)
+        if offset < os.path.getsize(self.path):
+            self._file.truncate(offset)
+        for pair_id in self._pairs:
+            self._update_good(pair_id)
+        self._unsaved = 1 if offset > indexed else 0
+
+    def _index(self, offset, record, length):
+        if "pair" in record:
+            entry = self._pairs.get(record["pair"])
+            if entry is not None:
+                entry[2] += record["rating"]
+                entry[3] += 1
+        else:
+            self._pairs[offset] = [self._key(record), length, 0, 0]
+
+    def _update_good(self, pair_id):
+        key, _, rating_sum, rating_count = self._pairs[pair_id]
+        good = rating_count >= self.min_ratings and rating_sum >= self.min_rating * rating_count
+        position = self._good_positions.get(pair_id)
+        if good and position is None:
+            ids = self._good.setdefault(key, [])
+            self._good_positions[pair_id] = len(ids)
+            ids.append(pair_id)
+        elif not good and position is not None:
+            # Swap with the last id so removal is O(1)
+            ids = self._good[key]
+            last = ids.pop()
+            if last != pair_id:
+                ids[position] = last
+                self._good_positions[last] = position
+            del self._good_positions[pair_id]
+            if not ids:
+                del self._good[key]
+
+    def _append(self, record):
+        line = (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        offset = self._file.seek(0, os.SEEK_END)
+        self._file.write(line)
+        self._file.flush()
+        self._index(offset, record, len(line))
+        self._unsaved += 1
+        if self._unsaved >= self.save_index_every:
+            self._save_index()
+        return offset
+
+    def add(self, selection, strong, weak):
+        """
+        Append a generated essay pair.
+
+        Parameters:
+        - selection (dict): Value of each of SELECTION_FIELDS.
+        - strong (str), weak (str): The essays.
+
+        Returns:
+        - int: Id of the pair, for use with `rate`.
+        """
+        record = {field: selection[field] for field in SELECTION_FIELDS}
+        record.update(strong=strong, weak=weak, created_at=round(time.time(), 3))
+        with self._lock:
+            return self._append(record)
+
+    def rate(self, pair_id, rating):
+        """Append a student's rating (1-5) of the strong essay of a pair."""
+        with self._lock:
+            if pair_id not in self._pairs:
+                return
+            self._append({"pair": pair_id, "rating": rating, "created_at": round(time.time(), 3)})
+            self._update_good(pair_id)
+
+    def has(self, selection):
+        """Return whether `sample` has a pair for the selection."""
+        return self._key(selection) in self._good
+
+    def _read(self, pair_id, length):
+        return json.loads(os.pread(self._fd, length, pair_id))
+
+    def sample(self, selection):
+        """
+        Return a random well-rated pair for a selection.
+
+        Returns:
+        - dict or None: {"id", "strong", "weak"}, or None if no pair for the selection is rated well enough.
+        """
+        with self._lock:
+            ids = self._good.get(self._key(selection))
+            pair_id = random.choice(ids) if ids else None
+            length = self._pairs[pair_id][1] if ids else None
+        METRICS.inc("essay_corpus_requests", result="miss" if pair_id is None else "hit")
+        if pair_id is None:
+            return None
+        record = self._read(pair_id, length)
+        return {"id": pair_id, "strong": record["strong"], "weak": record["weak"]}
+
+    def iter_pairs(self, min_rating=None):
+        """
+        Yield every pair with its selection and ratings, in the order they were added.
+
+        Parameters:
+        - min_rating (float): Only yield pairs rated at least this on average.
+        """
+        ratings = {}
+        with open(self.path, "rb") as file:
+            for line in file:
+                record = json.loads(line)
+                if "pair" in record:
+                    ratings.setdefault(record["pair"], []).append(record["rating"])
+        with open(self.path, "rb") as file:
+            offset = 0
+            for line in file:
+                record = json.loads(line)
+                if "pair" not in record:
+                    pair_ratings = ratings.get(offset, [])
+                    mean = sum(pair_ratings) / len(pair_ratings) if pair_ratings else None
+                    if min_rating is None or (mean is not None and mean >= min_rating):
+                        yield dict(record, id=offset, ratings=pair_ratings)
+                offset += len(line)
+
+    def stats(self):
+        """Return (number of pairs, number of rated pairs, number of selections with a servable pair)."""
+        with self._lock:
+            rated = sum(1 for entry in self._pairs.values() if entry[3])
+            return len(self._pairs), rated, len(self._good)
+
+    def _save_index(self):
+        size = self._file.seek(0, os.SEEK_END)
+        temporary = self.index_path + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump({"size": size, "pairs": self._pairs}, file, separators=(",", ":"))
+        os.replace(temporary, self.index_path)
+        self._unsaved = 0
+
+    def close(self):
+        with self._lock:
+            if self._unsaved:
+                self._save_index()
+            self._file.close()
+            os.close(self._fd)
+
+
+def open_essay_corpus(settings, base_dir):
+    """
+    Open the essay corpus configured in settings.yaml.
+
+    Parameters:
+    - settings (dict): Contents of settings.yaml.
+    - base_dir (str): Directory that a relative essay_corpus_path is resolved against.
+
+    Returns:
+    - EssayCorpus: The corpus.
+    """
+    return EssayCorpus(
+        os.path.join(base_dir, settings.get('essay_corpus_path', 'essay_corpus.jsonl')),
+        min_rating=settings.get('essay_corpus_min_rating', 4),
+        min_ratings=settings.get('essay_corpus_min_ratings', 1)
+    )
+
+
+def main():
+    from utils import get_src_dir, load_yaml_settings
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--export", default=None, help="Write the pairs with their ratings to this JSONL file.")
+    parser.add_argument("--min-rating", type=float, default=None, help="Only export pairs rated at least this on average.")
+    args = parser.parse_args()
+
+    path = get_src_dir()
+    settings = load_yaml_settings(os.environ.get("RAPIDFIRE_SETTINGS", os.path.join(path, "settings.yaml")))
+    corpus = open_essay_corpus(settings, path)
+    pairs, rated, selections = corpus.stats()
+    print(f"{pairs} pairs, {rated} rated, {selections} selections served from the corpus")
+    if args.export:
+        exported = 0
+        with open(args.export, "w") as file:
+            for pair in corpus.iter_pairs(args.min_rating):
+                file.write(json.dumps(pair, ensure_ascii=False) + "\n")
+                exported += 1
+        print(f"Exported {exported} pairs to {args.export}")
+    corpus.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import METRICS
+from utils import LatencyPolicy, count_tokens
+
+# Rate limiting (429), overload and transient network errors
+def retryable_errors():
+    """OpenAI errors worth retrying. openai is imported here rather than at startup, as it is slow to import."""
+    from openai.error import APIConnectionError, RateLimitError, ServiceUnavailableError, Timeout, TryAgain
+    return (RateLimitError, ServiceUnavailableError, TryAgain, Timeout, APIConnectionError)
+
+
+class _AbandonedCall(Exception):
+    """Raised to callers waiting on a streamed call whose consumer stopped reading it."""
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at `per_minute` units per minute.
+    """
+
+    def __init__(self, per_minute, capacity=None):
+        """
+        Parameters:
+        - per_minute (float): Refill rate.
+        - capacity (float): Maximum burst size. Defaults to one minute's worth.
+        """
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self._level = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount=1):
+        """Block until `amount` units are available, then take them."""
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._level >= amount:
+                    self._level -= amount
+                    return
+                wait = (amount - self._level) / self.rate
+            time.sleep(wait)
+
+    def consume(self, amount):
+        """Take `amount` units without waiting. The bucket may go into debt, delaying later acquires."""
+        with self._lock:
+            self._refill()
+            self._level -= amount
+
+
+class LLMGateway:
+    """
+    Process-wide front door for every LLM call.
+
+    - Identical prompts that are in flight at the same time are coalesced: one upstream call
+      serves every caller (single-flight).
+    - Calls are paced by request-per-minute and token-per-minute token buckets.
+    - Rate-limit (429), overloaded and transient network errors are retried with exponential
+      backoff and jitter, honouring the server's Retry-After header when present.
+    - Each upstream call runs under a LatencyPolicy (deadline, hedge request, fallback model).
+
+    The gateway is called like the wrapped client (`gateway(prompt)`, `gateway.stream(prompt)`),
+    so it can be used anywhere the client from load_LLM is. Prompts are strings or ChatPrompts.
+    """
+
+    def __init__(self, llm, requests_per_minute=200, tokens_per_minute=40000, max_retries=5,
+                 base_delay=1.0, max_delay=60.0, fallback_llm=None, policy=None, stream_policy=None):
+        """
+        Parameters:
+        - llm: Chat client returned by load_LLM.
+        - requests_per_minute (float): Maximum rate of upstream calls.
+        - tokens_per_minute (float): Maximum rate of prompt plus completion tokens.
+        - max_retries (int): Retries for a call that keeps getting rate limited.
+        - base_delay (float), max_delay (float): Backoff in seconds is base_delay * 2 ** attempt, capped at max_delay.
+        - fallback_llm: Faster LLM used when a call misses its deadline.
+        - policy (LatencyPolicy): Policy for blocking calls. Defaults to no hedging and no deadline.
+        - stream_policy (LatencyPolicy): Policy for the first token of streamed calls.
+        """
+        self.llm = llm
+        self.fallback_llm = fallback_llm
+        self.policy = policy or LatencyPolicy("blocking")
+        self.stream_policy = stream_policy or LatencyPolicy("stream")
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _join(self, prompt):
+        """Return (future, is_leader) for a prompt, registering a new in-flight call if there is none."""
+        with self._lock:
+            future = self._inflight.get(prompt)
+            if future is not None:
+                return future, False
+            future = self._inflight[prompt] = Future()
+            return future, True
+
+    def _finish(self, prompt, future, result=None, error=None):
+        with self._lock:
+            self._inflight.pop(prompt, None)
+        if isinstance(error, GeneratorExit):
+            future.set_exception(_AbandonedCall())
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _acquire(self, prompt):
+        """
+        Wait until the buckets admit a request. Called before the LatencyPolicy starts, so time spent
+        queueing here does not count toward hedge_after or the deadline.
+        """
+        self._requests.acquire()
+        self._tokens.acquire(count_tokens(prompt))
+
+    def _charge(self, prompt):
+        """Count a hedge or fallback request against the buckets without waiting, as the policy's clock is running."""
+        self._requests.consume(1)
+        self._tokens.consume(count_tokens(prompt))
+
+    def _admitted(self, prompt, open_request):
+        """
+        Wrap a request for a LatencyPolicy, which may run it more than once: the first run was admitted
+        by `_acquire`, and later runs (hedges) are charged with `_charge`.
+        """
+        runs = itertools.count()
+
+        def run():
+            if next(runs):
+                self._charge(prompt)
+            return open_request()
+        return run
+
+    def _should_retry(self, error, attempt):
+        return attempt < self.max_retries and isinstance(error, retryable_errors())
+
+    def _backoff(self, error, attempt):
+        retry_after = (getattr(error, "headers", None) or {}).get("retry-after")
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+        time.sleep(delay)
+
+    @staticmethod
+    def _record_tokens(model, prompt, response):
+        METRICS.inc("llm_prompt_tokens", count_tokens(prompt), model=model)
+        METRICS.inc("llm_completion_tokens", count_tokens(response), model=model)
+
+    def _attempt(self, llm, prompt):
+        model = getattr(llm, "model_name", "unknown")
+        with METRICS.span("llm_call", model=model, mode="blocking"):
+            response = llm(prompt)
+        self._record_tokens(model, prompt, response)
+        return response
+
+    def _attempt_stream(self, llm, prompt):
+        model = getattr(llm, "model_name", "unknown")
+        started = time.perf_counter()
+        response = ""
+        with METRICS.span("llm_call", model=model, mode="stream"):
+            for chunk in llm.stream(prompt):
+                if not response:
+                    METRICS.observe("llm_first_token", time.perf_counter() - started, model=model)
+                response += chunk
+                yield chunk
+        self._record_tokens(model, prompt, response)
+
+    def _call_upstream(self, prompt):
+        fallback = None
+        if self.fallback_llm is not None:
+            def fallback():
+                self._charge(prompt)
+                return self._attempt(self.fallback_llm, prompt)
+
+        attempt = 0
+        while True:
+            self._acquire(prompt)
+            try:
+                response = self.policy.call(self._admitted(prompt, lambda: self._attempt(self.llm, prompt)), fallback)
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+                METRICS.inc("llm_retries", error=type(e).__name__)
+                self._backoff(e, attempt)
+                attempt += 1
+            else:
+                self._tokens.consume(count_tokens(response))
+                return response
+
+    def __call__(self, prompt, coalesce=True):
+        """
+        Return the LLM's response to a prompt, sharing the result with identical concurrent calls.
+
+        Parameters:
+        - prompt (str): The prompt to send.
+        - coalesce (bool): Set to False when a fresh, independent response is wanted
+          (e.g. generating several variants of the same prompt).
+        """
+        if not coalesce:
+            return self._call_upstream(prompt)
+
+        future, is_leader = self._join(prompt)
+        if not is_leader:
+            METRICS.inc("llm_coalesced", mode="blocking")
+            try:
+                return future.result()
+            except _AbandonedCall:
+                return self(prompt)
+
+        try:
+            response = self._call_upstream(prompt)
+        except BaseException as e:
+            self._finish(prompt, future, error=e)
+            raise
+        self._finish(prompt, future, result=response)
+        return response
+
+    def _stream_upstream(self, prompt):
+        open_fallback = None
+        if self.fallback_llm is not None:
+            def open_fallback():
+                self._charge(prompt)
+                return self._attempt_stream(self.fallback_llm, prompt)
+
+        response = ""
+        attempt = 0
+        while True:
+            self._acquire(prompt)
+            open_stream = self._admitted(prompt, lambda: self._attempt_stream(self.llm, prompt))
+            try:
+                for chunk in self.stream_policy.stream(open_stream, open_fallback):
+                    response += chunk
+                    yield chunk
+                break
+            except Exception as e:
+                # Only retry if nothing has been shown to the student yet
+                if response or not self._should_retry(e, attempt):
+                    raise
+                METRICS.inc("llm_retries", error=type(e).__name__)
+                self._backoff(e, attempt)
+                attempt += 1
+        self._tokens.consume(count_tokens(response))
+
+    def stream(self, prompt, coalesce=True):
+        """
+        Stream the LLM's response to a prompt. A caller that joins an identical in-flight call
+        receives the whole response as a single chunk once it is finished.
+
+        Parameters:
+        - prompt (str): The prompt to send.
+        - coalesce (bool): Set to False when a fresh, independent response is wanted.
+        """
+        if not coalesce:
+            yield from self._stream_upstream(prompt)
+            return
+
+        future, is_leader = self._join(prompt)
+        if not is_leader:
+            METRICS.inc("llm_coalesced", mode="stream")
+            try:
+                yield future.result()
+            except _AbandonedCall:
+                yield from self.stream(prompt)
+            return
+
+        response = ""
+        try:
+            for chunk in self._stream_upstream(prompt):
+                response += chunk
+                yield chunk
+        except BaseException as e:
+            self._finish(prompt, future, error=e)
+            raise
+        self._finish(prompt, future, result=response)
+
+
+def open_llm_gateway(llm, settings, fallback_llm=None):
+    """
+    Wrap an LLM in a gateway configured from settings.yaml.
+    """
+    return LLMGateway(
+        llm,
+        requests_per_minute=settings.get('llm_requests_per_minute', 200),
+        tokens_per_minute=settings.get('llm_tokens_per_minute', 40000),
+        max_retries=settings.get('llm_max_retries', 5),
+        fallback_llm=fallback_llm,
+        policy=LatencyPolicy(
+            "blocking",
+            hedge_after=settings.get('llm_hedge_after_seconds'),
+            deadline=settings.get('llm_deadline_seconds')
+        ),
+        stream_policy=LatencyPolicy(
+            "stream",
+            hedge_after=settings.get('llm_stream_hedge_after_seconds'),
+            deadline=settings.get('llm_stream_deadline_seconds')
+        )
+    )
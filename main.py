@@ -1,29 +1,60 @@
 import streamlit as st
-from langchain import PromptTemplate
-from utils import load_data, get_src_dir, load_api_key_from_file, load_LLM, \
-    load_file_to_list, load_yaml_settings, create_pdf, send_email_with_pdf
+from resources import RerunTimer, get_settings, get_text, get_list, get_prompt_template, get_api_config, get_llm
+from utils import get_src_dir, build_email_with_pdf, stream_llm, run_concurrently, merge_streams, run_in_thread, warm_up
+from prefetch import EssayPrefetcher
+from essay_cache import open_essay_cache
+from essay_corpus import open_essay_corpus
+from memory import ConversationMemory
+from report_draft import ReportDrafter
+from outbox import open_email_outbox
+from metrics import METRICS, start_metrics_server
+from session_store import open_session_store
+from scheduler import LLMScheduler
+from digest import open_report_digest
+from report_pdf import REPORT_RENDERER
+from token_ledger import open_token_ledger
 import random
 import base64
-import yagmail
+import io
+import json
+from collections import namedtuple
+from concurrent.futures import CancelledError
+import os
 
 from os.path import join, exists
 
+rerun_timer = RerunTimer()
+
+def rerun():
+    """
+    Record this run's timing, then rerun the script. st.experimental_rerun raises, so the end of the
+    script, where the timing is otherwise recorded, is not reached by the runs that call the LLM.
+    """
+    rerun_timer.mark("page")
+    rerun_timer.finish(st.session_state.get("last_page", "Module 1: Mad Libs"))
+    st.experimental_rerun()
+
 PATH = get_src_dir()
 pathToPrompts = join(PATH, "prompts")
 
-# Load the settings from settings.yaml
-SETTINGS = load_yaml_settings(join(PATH, "settings.yaml"))
+# Load the settings from settings.yaml (cached until the file changes).
+# RAPIDFIRE_SETTINGS can point at another settings file, e.g. for the benchmark harness.
+SETTINGS = get_settings(os.environ.get("RAPIDFIRE_SETTINGS", join(PATH, "settings.yaml")))
 
-module_one_template = load_data(join(pathToPrompts, "module_one.txt"))
-module_one_prompt = PromptTemplate(
-    input_variables=["strong_attribute", "weak_attribute", "identity", "wildcard", "common_essay_prompt"],
-    template=module_one_template,
-)
+# Module 1 writes the strong and weak essays with two independent, concurrent requests
+ModuleOnePrompts = namedtuple("ModuleOnePrompts", ["strong", "weak"])
+
+def get_module_one_prompts():
+    # The instructions at the top of each file are sent as a fixed system message, the filled-in fields as the user message
+    return {
+        "strong": get_prompt_template(join(pathToPrompts, "module_one_strong.txt")),
+        "weak": get_prompt_template(join(pathToPrompts, "module_one_weak.txt")),
+    }
 
 # Load API key either from local machine or from streamlit secrets
 key_path = join(PATH, "config.txt")
 if exists(key_path):
-    config = load_api_key_from_file(key_path)
+    config = get_api_config(key_path)
     API_KEY = config.get('API_KEY')
     EMAIL_PASSWORD = config.get('EMAIL_PASSWORD')
     if not API_KEY:
@@ -33,37 +64,372 @@ else:
     API_KEY = st.secrets["openai_secret_key"]
     EMAIL_PASSWORD = st.secrets["email_password"]
 
-# Register email account
-# yagmail.register(SETTINGS['sender_email'], EMAIL_PASSWORD)
+@st.cache_resource
+def start_metrics():
+    # Prometheus endpoint and JSONL event log, shared by every session in the process
+    if SETTINGS.get('metrics_log_path'):
+        METRICS.enable_jsonl(join(PATH, SETTINGS['metrics_log_path']),
+                             max_bytes=SETTINGS.get('metrics_log_max_bytes', 10 * 2 ** 20),
+                             backup_count=SETTINGS.get('metrics_log_backups', 5))
+    if SETTINGS.get('metrics_port'):
+        try:
+            return start_metrics_server(SETTINGS['metrics_port'])
+        except OSError as e:
+            st.warning(f"Metrics endpoint not started: {e}")
+
+start_metrics()
+
+@st.cache_resource
+def get_email_outbox():
+    # One background sender and SMTP connection for the whole process
+    return open_email_outbox(SETTINGS, PATH, EMAIL_PASSWORD)
+
+# Started with the process, so mail queued before a restart is sent without waiting for a student to reach Module 3
+get_email_outbox()
+
+# In digest mode, reports are collected and each counselor gets one email a day
+DIGEST_MODE = SETTINGS.get('digest_mode', False)
+
+@st.cache_resource
+def get_report_digest():
+    # One background job for the whole process, sending through the shared outbox
+    return open_report_digest(SETTINGS, PATH, get_email_outbox())
+
+# Started with the process, so digests that came due while the app was down are sent right away
+if DIGEST_MODE:
+    get_report_digest()
 
 # Load LLM
-llm = load_LLM(API_KEY)
-
-@st.cache_data(show_spinner=False)  # Disable the spinner for a cleaner UI
-def get_module_one_output(prompt_with_attributes):
-    return llm(prompt_with_attributes)
+STREAM_RESPONSES = SETTINGS.get('stream_responses', False)
+# Every LLM call goes through its model's process-wide gateway (single-flight, rate limits, 429 backoff)
+LLM_MODEL = SETTINGS.get('llm_model', 'gpt-4')
+llm = get_llm(API_KEY, SETTINGS, LLM_MODEL)
+
+# Each Module 1 essay can use its own model, e.g. a cheaper, faster one for the weak essay
+module_one_llms = {
+    "strong": get_llm(API_KEY, SETTINGS, SETTINGS.get('module_one_strong_model', LLM_MODEL)),
+    "weak": get_llm(API_KEY, SETTINGS, SETTINGS.get('module_one_weak_model', LLM_MODEL)),
+}
+
+# Module 2 switches to the cheaper model when a student nears their token budget
+budget_llm = get_llm(API_KEY, SETTINGS, SETTINGS.get('budget_cheap_model', 'gpt-3.5-turbo'))
+
+@st.cache_resource
+def get_token_ledger():
+    # Prompt and completion tokens per session and per day, with the budgets they are held to
+    return open_token_ledger(SETTINGS, PATH)
+
+token_ledger = get_token_ledger()
+
+def metered(llm):
+    """Return llm with every call counted against this student's token budget. Can be called from worker threads."""
+    return token_ledger.meter(llm, st.session_state.session_token)
+
+@st.cache_resource
+def get_essay_cache():
+    # Finished Module 1 outputs keyed by prompt, shared by every session and kept across restarts
+    return open_essay_cache(SETTINGS, PATH)
+
+essay_cache = get_essay_cache()
+
+@st.cache_resource
+def get_essay_corpus():
+    # Every generated essay pair with its selection and ratings, and the index of well-rated pairs
+    return open_essay_corpus(SETTINGS, PATH)
+
+essay_corpus = get_essay_corpus()
+
+# Rendered report PDFs are cached by content, up to this total size
+REPORT_RENDERER.cache_max_bytes = SETTINGS.get('pdf_cache_max_mb', 32) * 2 ** 20
+
+@st.cache_resource
+def get_llm_scheduler():
+    # Caps concurrent LLM work across all sessions: chat turns first, then essays, then background work
+    return LLMScheduler(max_concurrency=SETTINGS.get('llm_max_concurrency', 8))
+
+llm_scheduler = get_llm_scheduler()
+
+def in_background(fn):
+    """Run fn in this student's background-priority LLM slots. The result can be called from worker threads."""
+    return llm_scheduler.wrap(fn, st.session_state.session_token, "background")
+
+def show_queue_position(placeholder):
+    """Return an on_wait callback that shows the student's place in the LLM queue in the placeholder."""
+    def on_wait(ahead, eta_seconds):
+        placeholder.info(f"RapidFire is busy right now. You're number {ahead + 1} in line "
+                         f"(about {max(1, round(eta_seconds))} seconds).")
+    return on_wait
+
+def wants_new_variant(prompt):
+    """
+    Whether to generate a fresh essay for a prompt instead of serving a cached one. Until the prompt has
+    essay_cache_variants variants, a new one is generated with essay_cache_new_variant_probability.
+    """
+    return (random.random() < SETTINGS.get('essay_cache_new_variant_probability', 0.5)
+            and essay_cache.variant_count(prompt) < essay_cache.variants_per_prompt)
+
+def generate_essay(llm, prompt):
+    # Also runs on background threads, so no Streamlit calls in here
+    new_variant = wants_new_variant(prompt)
+    essay = None if new_variant else essay_cache.get(prompt)
+    if essay is None:
+        # A new variant must not be coalesced with another student's call for the same prompt
+        essay = llm(prompt, coalesce=not new_variant).strip()
+        essay_cache.put(prompt, essay)
+    return essay
+
+def generate_module_one_output(prompts, llms):
+    """Generate the strong and weak essays for a pair of prompts concurrently with this student's metered LLMs."""
+    strong_essay, weak_essay = run_concurrently(
+        lambda: generate_essay(llms["strong"], prompts.strong),
+        lambda: generate_essay(llms["weak"], prompts.weak)
+    )
+    return {"strong": strong_essay, "weak": weak_essay}
+
+def metered_module_one_llms():
+    return {part: metered(module_one_llm) for part, module_one_llm in module_one_llms.items()}
+
+def get_module_one_output(prompts, selection, on_partial=None, on_wait=None):
+    """
+    Return the essay pair for a selection as {"strong", "weak", "id"}: a well-rated pair from the corpus if
+    there is one, otherwise a prefetched or newly generated pair, which is added to the corpus under its id.
+    """
+    with METRICS.span("module_one_output") as labels:
+        # Essays earlier students rated highly are served without calling the LLM
+        pair = essay_corpus.sample(selection) if SETTINGS.get('essay_corpus_serve', True) else None
+        if pair is not None:
+            labels["source"] = "corpus"
+            return pair
+
+        # A queued speculation is promoted now that the student is waiting for it
+        module_one_output = None
+        speculation = st.session_state.prefetcher.take(prompts)
+        if speculation is not None:
+            try:
+                module_one_output = llm_scheduler.wait(speculation, st.session_state.session_token, "essay", on_wait)
+                labels["source"] = "prefetch"
+            except Exception:
+                pass
+
+        if module_one_output is None:
+            labels["source"] = "generate"
+            with llm_scheduler.slot(st.session_state.session_token, "essay", on_wait):
+                if not (STREAM_RESPONSES and on_partial):
+                    module_one_output = generate_module_one_output(prompts, metered_module_one_llms())
+                else:
+                    module_one_output = stream_module_one_output(prompts, on_partial, metered_module_one_llms())
+
+    module_one_output["id"] = essay_corpus.add(selection, module_one_output["strong"], module_one_output["weak"])
+    return module_one_output
+
+def stream_module_one_output(prompts, on_partial, llms):
+    prompts = prompts._asdict()
+    new_variants = {part for part, prompt in prompts.items() if wants_new_variant(prompt)}
+    module_one_output = {part: None if part in new_variants else essay_cache.get(prompt)
+                         for part, prompt in prompts.items()}
+    missing = [part for part, essay in module_one_output.items() if essay is None]
+    for part, essay in module_one_output.items():
+        if essay is not None:
+            on_partial(part, essay)
+
+    # A new variant must not be coalesced with another student's call for the same prompt
+    streams = {part: (lambda part=part: llms[part].stream(prompts[part], coalesce=part not in new_variants))
+               for part in missing}
+    for part, partial_essay in merge_streams(streams):
+        on_partial(part, partial_essay)
+        module_one_output[part] = partial_essay
+    for part in missing:
+        module_one_output[part] = module_one_output[part].strip()
+        essay_cache.put(prompts[part], module_one_output[part])
+    return module_one_output
+
+def essay_selection(identity, wildcard, common_essay_prompt):
+    """The student's Module 1 selection, as stored in the essay corpus."""
+    return {"strong_attribute": strong_attr, "weak_attribute": weak_attr, "identity": identity,
+            "wildcard": wildcard, "common_essay_prompt": common_essay_prompt}
+
+def format_module_one_prompts(identity, wildcard, common_essay_prompt):
+    module_one_prompts = get_module_one_prompts()
+    return ModuleOnePrompts(
+        strong=module_one_prompts["strong"].format(
+            strong_attribute=strong_attr, identity=identity, wildcard=wildcard, common_essay_prompt=common_essay_prompt),
+        weak=module_one_prompts["weak"].format(
+            weak_attribute=weak_attr, identity=identity, wildcard=wildcard, common_essay_prompt=common_essay_prompt),
+    )
+
+def likely_next_prompts(identities, wildcards, common_essay_prompt):
+    """
+    Module 1 prompts for the next round, ordered from the default radio selection outwards.
+    Selections the corpus can serve are left out, as they will not need the LLM.
+    """
+    pairs = sorted(((i, w) for i in range(len(identities)) for w in range(len(wildcards))), key=sum)
+    serve_from_corpus = SETTINGS.get('essay_corpus_serve', True)
+    return [format_module_one_prompts(identities[i], wildcards[w], common_essay_prompt) for i, w in pairs
+            if not (serve_from_corpus and essay_corpus.has(essay_selection(identities[i], wildcards[w], common_essay_prompt)))]
+
+def create_brainstorm_memory():
+    # Load initial prompts from module_two.txt to start the conversation
+    return ConversationMemory(
+        get_text(join(pathToPrompts, "module_two.txt")),
+        summarize=in_background(metered(llm)),
+        summary_template=get_text(join(pathToPrompts, "summarize.txt")),
+        token_budget=SETTINGS.get('context_token_budget', 3000),
+        keep_recent=SETTINGS.get('context_keep_recent_messages', 6)
+    )
+
+def start_brainstorm():
+    """Create the Module 2 conversation and write its opening turn in the background."""
+    memory = st.session_state.memory = create_brainstorm_memory()
+    opening_llm = metered(llm)
+    st.session_state.opening_turn = run_in_thread(in_background(lambda: opening_llm(memory.render())))
+
+def create_report_drafter():
+    # Add user info from Module 1
+    user_info = f"""
+                First Name: {st.session_state.first_name}
+                Last Name: {st.session_state.last_name}
+                Email: {st.session_state.email}
+                School: {st.session_state.school}
+                Grade: {st.session_state.grade}
+                Counselor's Name: {st.session_state.counselor_name}
+                Counselor Email: {st.session_state.counselor_email}
+                Top Schools: {st.session_state.top_schools}
+                Zip Code: {st.session_state.zip_code}
+                """
+    token = st.session_state.session_token
+    return ReportDrafter(
+        in_background(metered(llm)),
+        transcript=lambda start: session_store.get_messages(token, start),
+        report_suffix=user_info + "\n\n" + get_text(join(pathToPrompts, "module_three.txt")),
+        update_template=get_text(join(pathToPrompts, "module_three_update.txt")),
+        refresh_every=SETTINGS.get('report_refresh_every_messages', 6)
+    )
+
+@st.cache_resource
+def get_session_store():
+    # Student progress, essays, transcripts and PDFs on disk, keyed by the token in the page URL
+    return open_session_store(SETTINGS, PATH)
+
+session_store = get_session_store()
+
+# Small values saved with the session; essays, the transcript and the report PDF are stored as artifacts
+PERSISTED_STATE = [
+    "first_name", "last_name", "email", "zip_code", "grade", "school", "counselor_name", "counselor_email",
+    "counselor_calendly", "top_schools", "has_started", "essay_count", "generate", "ratings",
+    "strong_attr", "weak_attr", "identity", "wildcard", "next_identity", "next_wildcard",
+    "module_completed", "generate_report", "report_generated", "show_email_sent_notification", "email_id",
+    "digest_id", "corpus_pair_id",
+    "current_page_idx", "last_page",
+]
+
+def restore_session():
+    """Attach this browser session to the progress stored under ?session=<token>, or start a new one."""
+    token = st.experimental_get_query_params().get("session", [None])[0]
+    state = session_store.load(token) if token else None
+    if state is None:
+        token = session_store.new_token()
+        st.experimental_set_query_params(session=token)
+    st.session_state.session_token = token
+    if state is not None:
+        st.session_state.update(state)
+        snapshot = session_store.get_artifact(token, "brainstorm_memory")
+        if snapshot:
+            st.session_state.memory = create_brainstorm_memory()
+            st.session_state.memory.restore(json.loads(snapshot))
+    save_session()
+
+def save_session():
+    """Save the small session values and the brainstorm memory if they changed since the last save."""
+    token = st.session_state.session_token
+    state = json.dumps({key: st.session_state[key] for key in PERSISTED_STATE if key in st.session_state})
+    if state != st.session_state.get("saved_state"):
+        session_store.save(token, json.loads(state))
+        st.session_state.saved_state = state
+
+    memory = st.session_state.get("memory")
+    if memory is not None and (memory.count, memory.summary) != st.session_state.get("saved_memory"):
+        session_store.put_artifact(token, "brainstorm_memory", json.dumps(memory.snapshot()))
+        st.session_state.saved_memory = (memory.count, memory.summary)
+
+def add_brainstorm_message(role, content):
+    """
+    Add a Module 2 message to the conversation memory, which only keeps the turns not yet summarized,
+    and to the full transcript stored with the session.
+    """
+    session_store.append_message(st.session_state.session_token, role, content)
+    st.session_state.memory.add(role, content)
+
+def budgeted_chat_request(memory, plan):
+    """
+    Return (prompt, llm) for the next Module 2 turn, degraded by the student's BudgetPlan: the compact
+    preamble once they near their token budget, then a shorter history, then the cheaper model.
+    """
+    options = {}
+    if plan.compress:
+        options["preamble"] = get_text(join(pathToPrompts, "module_two_compact.txt"))
+    if plan.shorten:
+        options["token_budget"] = SETTINGS.get('budget_short_history_tokens', 1500)
+        options["keep_recent"] = max(2, memory.keep_recent // 2)
+    for step in ("compress", "shorten", "downgrade"):
+        if getattr(plan, step):
+            METRICS.inc("token_budget_degraded", step=step)
+    return memory.render(**options), metered(budget_llm if plan.downgrade else llm)
+
+def get_llm_response(memory, plan, placeholder):
+    """
+    Get the LLM's response to a chat turn within the student's token budget. The placeholder shows
+    the queue position while waiting for a slot, then the response (token by token when streaming).
+    """
+    prompt, chat_llm = budgeted_chat_request(memory, plan)
+    with llm_scheduler.slot(st.session_state.session_token, "chat", on_wait=show_queue_position(placeholder)):
+        if not STREAM_RESPONSES:
+            response = chat_llm(prompt)
+        else:
+            response = ""
+            for response in stream_llm(chat_llm, prompt):
+                placeholder.markdown(response + "▌")
+    placeholder.markdown(response)
+    return response
+
+# Restore progress after a reload or restart; otherwise save what the previous rerun changed
+if 'session_token' not in st.session_state:
+    restore_session()
+else:
+    save_session()
+session_token = st.session_state.session_token
 
 # Load attributes for Module 1
 if 'strong_attr' not in st.session_state:
-    st.session_state.strong_attr = random.sample(load_file_to_list(join(pathToPrompts, "strong_attributes.txt")), 1)[0]
+    st.session_state.strong_attr = random.sample(get_list(join(pathToPrompts, "strong_attributes.txt")), 1)[0]
 strong_attr = st.session_state.strong_attr
 
 if 'weak_attr' not in st.session_state:
-    st.session_state.weak_attr = random.sample(load_file_to_list(join(pathToPrompts, "weak_attributes.txt")), 1)[0]
+    st.session_state.weak_attr = random.sample(get_list(join(pathToPrompts, "weak_attributes.txt")), 1)[0]
 weak_attr = st.session_state.weak_attr
 
 if 'wildcard' not in st.session_state:
-    st.session_state.wildcard = random.sample(load_file_to_list(join(pathToPrompts, "wildcard.txt")), 4)
+    st.session_state.wildcard = random.sample(get_list(join(pathToPrompts, "wildcard.txt")), 4)
 wildcard = st.session_state.wildcard
 
 if 'identity' not in st.session_state:
-    st.session_state.identity = random.sample(load_file_to_list(join(pathToPrompts, "identity.txt")), 4)
+    st.session_state.identity = random.sample(get_list(join(pathToPrompts, "identity.txt")), 4)
 identity = st.session_state.identity
 
 if 'common_prompt' not in st.session_state:
-    st.session_state.common_prompt = load_file_to_list(join(pathToPrompts, "common_questions.txt"))
+    st.session_state.common_prompt = get_list(join(pathToPrompts, "common_questions.txt"))
 common_prompt = st.session_state.common_prompt
 
+# Background worker that generates likely next essay pairs while the student rates the current one
+if 'prefetcher' not in st.session_state:
+    prefetch_llms = metered_module_one_llms()
+    st.session_state.prefetcher = EssayPrefetcher(
+        in_background(lambda prompts: generate_module_one_output(prompts, prefetch_llms)),
+        max_workers=SETTINGS.get('prefetch_workers', 2),
+        max_speculations=SETTINGS.get('prefetch_speculations', 2)
+    )
+
+rerun_timer.mark("setup")
+
 ####### Streamlit UI #######
 # Initialize the state variable for module completion
 if "module_completed" not in st.session_state:
@@ -91,7 +457,7 @@ if selected_page != st.session_state.get("last_page", None):
     page = selected_page
     st.session_state.current_page_idx = possible_pages.index(page)  # Update session state with current page index
     st.session_state.last_page = selected_page
-    st.experimental_rerun()
+    rerun()
 else:
     page = st.session_state.get("last_page", "Module 1: Mad Libs")
 
@@ -106,9 +472,6 @@ if page == "Module 1: Mad Libs":
     if "generate" not in st.session_state:
         st.session_state.generate = False
 
-    if "all_strong_essays" not in st.session_state:
-        st.session_state.all_strong_essays = []
-    
     if "ratings" not in st.session_state:
         st.session_state.ratings = []
 
@@ -144,7 +507,7 @@ if page == "Module 1: Mad Libs":
 
             if start_btn_col.button("Start the Process of Crafting Your Authentic College Essay"):
                 st.session_state.has_started = True
-                st.experimental_rerun()
+                rerun()
 
     else:
         if st.session_state.essay_count >= SETTINGS['num_rounds']:
@@ -185,44 +548,62 @@ if page == "Module 1: Mad Libs":
             if btn_generate_col.button("Generate"):
                 st.session_state.generate = True
 
-                prompt_with_attributes = module_one_prompt.format(
-                    strong_attribute=strong_attr,
-                    weak_attribute=weak_attr,
-                    identity=selected_identity,
-                    wildcard=selected_wildcard,
-                    common_essay_prompt=selected_common_prompt
-                )
+                prompts_with_attributes = format_module_one_prompts(selected_identity, selected_wildcard, selected_common_prompt)
+
+                # Place in the LLM queue while RapidFire is busy, then panes that show the essays as they are written
+                queue_placeholder = st.empty()
+                stream_col_strong, stream_col_weak = st.columns(2)
+                stream_col_strong.subheader("Stronger Essay")
+                stream_col_weak.subheader("Weaker Essay")
+                essay_placeholders = {"strong": stream_col_strong.empty(), "weak": stream_col_weak.empty()}
 
-                module_one_output = get_module_one_output(prompt_with_attributes)
+                def show_partial_essay(part, partial_essay):
+                    queue_placeholder.empty()
+                    essay_placeholders[part].markdown(partial_essay)
 
-                # Parsing the output to get strong and weak essays
-                start_strong = module_one_output.find('Strong Essay') + len('Strong Essay') + 1
-                start_weak = module_one_output.find('Weak Essay')
-                end_strong = start_weak - 1
+                selection = essay_selection(selected_identity, selected_wildcard, selected_common_prompt)
+                module_one_output = get_module_one_output(prompts_with_attributes, selection, on_partial=show_partial_essay,
+                                                          on_wait=show_queue_position(queue_placeholder))
 
-                st.session_state.strong_essay = module_one_output[start_strong:end_strong].strip()
-                st.session_state.weak_essay = module_one_output[start_weak + len('Weak Essay') + 1:].strip()
+                st.session_state.corpus_pair_id = module_one_output["id"]
+                session_store.put_artifact(session_token, "strong_essay", module_one_output["strong"])
+                session_store.put_artifact(session_token, "weak_essay", module_one_output["weak"])
 
                 # Append the new strong essay to the list
-                st.session_state.all_strong_essays.append(st.session_state.strong_essay)
+                all_strong_essays = json.loads(session_store.get_artifact(session_token, "all_strong_essays", "[]"))
+                all_strong_essays.append(module_one_output["strong"])
+                session_store.put_artifact(session_token, "all_strong_essays", json.dumps(all_strong_essays))
+
+                # Replace the streaming panes with the regular essay panes
+                rerun()
             
             # Shuffle button in the right (btn_shuffle_col) column
             if btn_shuffle_col.button('Shuffle Options'):
-                st.session_state.identity = random.sample(load_file_to_list(join(pathToPrompts, "identity.txt")), 4)
-                st.session_state.wildcard = random.sample(load_file_to_list(join(pathToPrompts, "wildcard.txt")), 4)
-                st.experimental_rerun()
+                st.session_state.identity = random.sample(get_list(join(pathToPrompts, "identity.txt")), 4)
+                st.session_state.wildcard = random.sample(get_list(join(pathToPrompts, "wildcard.txt")), 4)
+                rerun()
 
             # If essays are generated, display them
             if st.session_state.generate:
+                # Options for the next round are sampled now so their essays can be prefetched while rating
+                if 'next_identity' not in st.session_state:
+                    st.session_state.next_identity = random.sample(get_list(join(pathToPrompts, "identity.txt")), 4)
+                    st.session_state.next_wildcard = random.sample(get_list(join(pathToPrompts, "wildcard.txt")), 4)
+                # Speculation spends tokens that may never be used, so it stops once the student nears their budget
+                if st.session_state.essay_count + 1 < SETTINGS['num_rounds'] and \
+                        not token_ledger.plan(session_token).compress:
+                    st.session_state.prefetcher.speculate(likely_next_prompts(
+                        st.session_state.next_identity, st.session_state.next_wildcard, selected_common_prompt))
+
                 col_strong, col_weak = st.columns(2)
 
                 with col_strong:
                     st.subheader("Stronger Essay")
-                    st.text_area("", value=st.session_state.strong_essay, height=400)
+                    st.text_area("", value=session_store.get_artifact(session_token, "strong_essay", ""), height=400)
 
                 with col_weak:
                     st.subheader("Weaker Essay")
-                    st.text_area("", value=st.session_state.weak_essay, height=400)
+                    st.text_area("", value=session_store.get_artifact(session_token, "weak_essay", ""), height=400)
 
                 with col_strong:
                     st.subheader("Rate the Strong Essay:")
@@ -234,10 +615,13 @@ if page == "Module 1: Mad Libs":
                         if cols[i-1].button(str(i), key=f"rate_{i}"):
                             st.session_state.ratings.append(i)
                             st.session_state.essay_count += 1
+                            # Well-rated pairs are served to later students who make the same selection
+                            if st.session_state.get("corpus_pair_id") is not None:
+                                essay_corpus.rate(st.session_state.pop("corpus_pair_id"), i)
 
-                            # Refresh the identity and wildcard options
-                            st.session_state.identity = random.sample(load_file_to_list(join(pathToPrompts, "identity.txt")), 4)
-                            st.session_state.wildcard = random.sample(load_file_to_list(join(pathToPrompts, "wildcard.txt")), 4)
+                            # Refresh the identity and wildcard options with the ones being prefetched
+                            st.session_state.identity = st.session_state.pop('next_identity')
+                            st.session_state.wildcard = st.session_state.pop('next_wildcard')
 
                             st.session_state.generate = False  # Reset generation state after rating
                             rerun_flag = True
@@ -245,9 +629,12 @@ if page == "Module 1: Mad Libs":
                     if rerun_flag:
                         if st.session_state.essay_count >= SETTINGS['num_rounds']:
                             st.session_state.module_completed = True
-                            st.experimental_rerun()
+                            st.session_state.prefetcher.shutdown()
+                            # The brainstorm's opening turn is ready by the time the student opens Module 2
+                            start_brainstorm()
+                            rerun()
                         else:
-                            st.experimental_rerun()
+                            rerun()
 
                 if st.session_state.ratings:
                     st.write(f"You rated the last essay {st.session_state.ratings[-1]} out of 5.")
@@ -259,48 +646,73 @@ elif page == "Module 2: Brainstorm":
             workshopping your essay during your in person meeting. 
             """)
 
-    if "context" not in st.session_state:
-        st.session_state.context = ""
+    if "memory" not in st.session_state:
+        start_brainstorm()
 
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
+    # Dropped once the report is stored, along with its copy of the report and PDF
+    if "report_drafter" not in st.session_state and not st.session_state.get("report_generated"):
+        st.session_state.report_drafter = create_report_drafter()
 
-        # Load initial prompts from module_two.txt and start the conversation
-        initial_prompt = load_data(join(pathToPrompts, "module_two.txt"))
-        st.session_state.context += "\n\n" + initial_prompt
+    # How close this student (and the app today) is to the token budget
+    budget_plan = token_ledger.plan(session_token)
 
-        # TODO: Debugging. Remove later.
-        # st.session_state.messages.append({"role": "assistant", "content": "[TOPIC IDENTIFIED]"})
-        
-        response = llm(st.session_state.context)
-        st.session_state.messages.append({"role": "assistant", "content": response}) # Only add the LLM's response
-        st.session_state.context += f"\n\n{response}"
+    if not st.session_state.memory.count:
+        with st.chat_message("assistant"):
+            placeholder = st.empty()
+            # Usually finished while the student was still in Module 1; not there after a restart
+            opening_turn = st.session_state.pop("opening_turn", None)
+            response = None
+            if opening_turn is not None:
+                try:
+                    response = llm_scheduler.wait(opening_turn, session_token, "chat", show_queue_position(placeholder))
+                    placeholder.markdown(response)
+                except CancelledError:
+                    pass  # written below instead
+            if response is None:
+                response = get_llm_response(st.session_state.memory, budget_plan, placeholder)
+        add_brainstorm_message("assistant", response) # Only add the LLM's response
+
+        # Rerun so the streamed opening message is drawn once, with the rest of the chat
+        rerun()
 
     if "generate_report" not in st.session_state:
         st.session_state.generate_report = False
 
     # Display the previous messages
     topic_identified = False
-    for message in st.session_state.messages:
+    for message in session_store.get_messages(session_token):
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
         if "[TOPIC IDENTIFIED]" in message["content"]:
             topic_identified = True
 
-    # Get user's input
-    prompt = st.chat_input("You: ")
+    # Get user's input, unless the token budget is used up
+    if budget_plan.exhausted:
+        prompt = None
+        st.warning("""
+                   This brainstorm has reached its usage limit, so RapidFire cannot reply anymore. Your conversation 
+                   is saved, and once a topic has been identified you can still generate the report for your counselor.
+                   """)
+    else:
+        prompt = st.chat_input("You: ")
     if prompt:
-        st.session_state.messages.append({"role": "user", "content": prompt})
-        st.session_state.context += f"\n\Student: {prompt}"
+        add_brainstorm_message("user", prompt)
 
-        # Obtain the LLM's response using the accumulated context and user's message
-        response = llm(st.session_state.context)
+        with st.chat_message("user"):
+            st.markdown(prompt)
 
-        st.session_state.messages.append({"role": "assistant", "content": response})
-        st.session_state.context += f"\n\n{response}"
+        # Obtain the LLM's response using the conversation memory and user's message
+        with st.chat_message("assistant"):
+            response = get_llm_response(st.session_state.memory, budget_plan, st.empty())
+
+        add_brainstorm_message("assistant", response)
+
+        # Keep the counselor report draft current in the background
+        if "report_drafter" in st.session_state:
+            st.session_state.report_drafter.refresh(st.session_state.memory, final="[TOPIC IDENTIFIED]" in response)
 
         # Force rerun to update the chat immediately
-        st.experimental_rerun()
+        rerun()
 
     # Check if topic was identified and display button
     if topic_identified:
@@ -314,27 +726,16 @@ elif page == "Module 2: Brainstorm":
                 st.session_state.generate_report = True
                 st.session_state.report_generated = True  # Update the state to hide the button
                 
-                # Add user info from Module 1
-                user_info = f"""
-                            First Name: {st.session_state.first_name}
-                            Last Name: {st.session_state.last_name}
-                            Email: {st.session_state.email}
-                            School: {st.session_state.school}
-                            Grade: {st.session_state.grade}
-                            Counselor's Name: {st.session_state.counselor_name}
-                            Counselor Email: {st.session_state.counselor_email}
-                            Top Schools: {st.session_state.top_schools}
-                            Zip Code: {st.session_state.zip_code}
-                            """
-                initial_prompt = load_data(join(pathToPrompts, "module_three.txt"))
-                st.session_state.context += "\n\n" + user_info + "\n\n" + initial_prompt
-                response = llm(st.session_state.context)
-
-                # Generate PDF from the context
-                pdf_buffer = create_pdf(response)
-                st.session_state.pdf_buffer = pdf_buffer
+                # Usually already drafted (and rendered to PDF) in the background
+                report_drafter, memory = st.session_state.report_drafter, st.session_state.memory
+                response, pdf_buffer = llm_scheduler.wait(run_in_thread(lambda: report_drafter.result(memory)),
+                                                          session_token, "chat", show_queue_position(st.empty()))
+                session_store.put_artifact(session_token, "report_text", response)
+                session_store.put_artifact(session_token, "report_pdf", pdf_buffer.getvalue())
+                st.session_state.report_drafter.shutdown()
+                del st.session_state.report_drafter
                 
-                st.experimental_rerun()
+                rerun()
         
         # If report has been generated, prompt the user to proceed to Module 3
         else:
@@ -350,10 +751,6 @@ elif page == "Module 3: Statement Starter Report":
             you might want to write about in your college essay.
             """)
     
-    # Load and append the initial prompts from module_three.txt
-    if "context" not in st.session_state:
-        st.session_state.context = ""
-    
     if "show_email_sent_notification" not in st.session_state:
         st.session_state.show_email_sent_notification = True
     
@@ -390,16 +787,55 @@ elif page == "Module 3: Statement Starter Report":
                             Statement Starter Team
                             """
                 try:
-                    send_email_with_pdf(f"{st.session_state.first_name} {st.session_state.last_name}", SETTINGS['sender_email'], 
-                                        st.session_state.counselor_email, subject, content, st.session_state.pdf_buffer, EMAIL_PASSWORD)
+                    if DIGEST_MODE:
+                        # Sent with the counselor's other reports at the next digest
+                        st.session_state.digest_id = get_report_digest().add(
+                            st.session_state.counselor_email, st.session_state.counselor_name,
+                            f"{st.session_state.first_name} {st.session_state.last_name}",
+                            session_store.get_artifact(session_token, "report_text", ""),
+                            session_store.get_artifact(session_token, "report_pdf"))
+                        st.session_state.show_email_sent_notification = False
+                        rerun()
+
+                    message = build_email_with_pdf(f"{st.session_state.first_name} {st.session_state.last_name}", SETTINGS['sender_email'], 
+                                                   st.session_state.counselor_email, subject, content,
+                                                   io.BytesIO(session_store.get_artifact(session_token, "report_pdf")))
+                    # Queued for the background sender, so the page does not wait on SMTP
+                    st.session_state.email_id = get_email_outbox().enqueue(message)
                     st.session_state.show_email_sent_notification = False  # Set the flag to hide the button and show the notification
-                    st.experimental_rerun()
+                    rerun()
                 except Exception as e:
                     st.error(f"An error occurred while sending the email: {str(e)}")
 
-        # Show the notification if the email was sent successfully
+        # Show the notification once the email is queued
         if not st.session_state.show_email_sent_notification:
-            st.info("""
-                    Congratulations! Your report has been sent to your counselor's email. 
-                    Don't forget to schedule an appointment with them using Calendly above.
-                    """)
\ No newline at end of file
+            if "digest_id" in st.session_state:
+                delivery = get_report_digest().status(st.session_state.digest_id)
+            else:
+                delivery = get_email_outbox().status(st.session_state.email_id)
+            if delivery.status == "scheduled":
+                st.info(f"""
+                        Congratulations! Your report will be sent to your counselor with their daily digest 
+                        ({delivery.send_at:%A at %H:%M}). Don't forget to schedule an appointment with them using Calendly above.
+                        """)
+            elif delivery.status == "failed":
+                st.error(f"An error occurred while sending the email: {delivery.last_error}")
+            else:
+                st.info("""
+                        Congratulations! Your report is on its way to your counselor's email. 
+                        Don't forget to schedule an appointment with them using Calendly above.
+                        """)
+
+save_session()
+rerun_timer.mark("page")
+rerun_ms = rerun_timer.finish(page)
+if SETTINGS.get('show_rerun_timing', False):
+    st.sidebar.caption(f"Rerun took {rerun_ms:.1f} ms")
+
+@st.cache_resource
+def start_warm_up():
+    # Once per process, after the first page has been shown: import what the LLM calls and reports need
+    return run_in_thread(lambda: warm_up(["openai", "fpdf"]))
+
+if SETTINGS.get('warm_up_after_first_paint', True):
+    start_warm_up()
@@ -0,0 +1,137 @@
+import threading
+
+from utils import ChatPrompt, count_tokens
+
+
+class ConversationMemory:
+    """
+    Structured memory for the Module 2 brainstorm conversation.
+
+    Only the turns not yet summarized are kept in `messages`; the full transcript is stored by the
+    caller. The prompt sent to the LLM is kept under a token budget: once it grows past the
+    budget, older turns are folded into a running summary on a background thread, one batch at
+    a time, and dropped, so the next turns only pay for the summary plus the most recent messages.
+    """
+
+    def __init__(self, preamble, summarize, summary_template, token_budget=3000, keep_recent=6):
+        """
+        Parameters:
+        - preamble (str): Stable instructions that start every prompt (module_two.txt).
+        - summarize (callable): Function taking a prompt and returning the LLM's response.
+          It runs on a background thread, so it must not use Streamlit APIs.
+        - summary_template (str): Template with {summary} and {turns} fields for the summarization prompt.
+        - token_budget (int): Maximum estimated number of tokens in a rendered prompt.
+        - keep_recent (int): Number of most recent messages that are never summarized.
+        """
+        self.preamble = preamble
+        self.messages = []
+        self.summary = ""
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self._summarize = summarize
+        self._summary_template = summary_template
+        self._summarized = 0  # number of messages covered by self.summary and dropped from self.messages
+        self._summarizing = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _format_message(message):
+        if message["role"] == "user":
+            return f"Student: {message['content']}"
+        return message["content"]
+
+    @property
+    def count(self):
+        """Number of messages added to the conversation, including the summarized ones."""
+        with self._lock:
+            return self._summarized + len(self.messages)
+
+    def add(self, role, content):
+        """
+        Append a message to the conversation and start summarizing older turns if the prompt is over budget.
+
+        Parameters:
+        - role (str): "user" or "assistant".
+        - content (str): Text of the message.
+        """
+        with self._lock:
+            self.messages.append({"role": role, "content": content})
+            unsummarized = "\n\n".join(self._format_message(message) for message in self.messages)
+            over_budget = count_tokens(self.preamble + self.summary + unsummarized) > self.token_budget
+        if over_budget:
+            self._start_summary()
+
+    def snapshot(self):
+        """
+        Return the unsummarized messages and summary as a JSON-serializable dict, for `restore`.
+        """
+        with self._lock:
+            return {"recent": list(self.messages), "summary": self.summary, "summarized": self._summarized}
+
+    def restore(self, snapshot):
+        """
+        Replace the unsummarized messages and summary with a `snapshot`, e.g. after a restart.
+        """
+        with self._lock:
+            self.messages = list(snapshot["recent"])
+            self.summary = snapshot["summary"]
+            self._summarized = snapshot["summarized"]
+
+    def render(self, suffix="", preamble=None, token_budget=None, keep_recent=None, history=None):
+        """
+        Render the prompt for the next LLM call.
+
+        Parameters:
+        - suffix (str): Extra instructions appended after the conversation (e.g. module_three.txt).
+        - preamble (str): Instructions to use instead of the memory's preamble, e.g. a compact version.
+        - token_budget (int), keep_recent (int): Tighter limits for this prompt only, e.g. near a token budget.
+        - history (list): Messages to render in full instead of the summary and recent turns, e.g. the whole
+          transcript for the first report draft. They are not trimmed to the budget.
+
+        Returns:
+        - ChatPrompt: The preamble as the fixed system message, then the summary of older turns, the
+          recent turns as user and assistant messages, and the suffix. While a summary is still being
+          written, the oldest unsummarized turns are dropped to stay within the budget.
+        """
+        with self._lock:
+            system = self.preamble if preamble is None else preamble
+            tail = [("user", suffix)] if suffix else []
+            if history is not None:
+                turns = [(message["role"], message["content"]) for message in history]
+                return ChatPrompt(system, tuple(turns + tail))
+
+            head = []
+            if self.summary:
+                head.append(("system", "Summary of the conversation so far:\n" + self.summary))
+
+            turns = [(message["role"], message["content"]) for message in self.messages]
+            keep_recent = self.keep_recent if keep_recent is None else keep_recent
+            budget = (token_budget or self.token_budget) - count_tokens(ChatPrompt(system, tuple(head + tail)))
+            while len(turns) > keep_recent and count_tokens(ChatPrompt("", tuple(turns))) > budget:
+                turns.pop(0)
+
+        return ChatPrompt(system, tuple(head + turns + tail))
+
+    def _start_summary(self):
+        with self._lock:
+            end = len(self.messages) - self.keep_recent
+            if self._summarizing or end <= 0:
+                return
+            self._summarizing = True
+            turns = "\n\n".join(self._format_message(message) for message in self.messages[:end])
+            prompt = self._summary_template.format(summary=self.summary or "(none yet)", turns=turns)
+
+        threading.Thread(target=self._fold_summary, args=(prompt, end), daemon=True).start()
+
+    def _fold_summary(self, prompt, end):
+        try:
+            summary = self._summarize(prompt).strip()
+        except Exception:
+            summary = None
+        with self._lock:
+            if summary:
+                self.summary = summary
+                # Messages added meanwhile are appended, so the first `end` are still the summarized ones
+                del self.messages[:end]
+                self._summarized += end
+            self._summarizing = False
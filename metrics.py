@@ -0,0 +1,195 @@
+"""
+In-process metrics for RapidFire.
+
+Timing spans and counters are aggregated across every session in the process and exported
+in Prometheus text format on a local port (`/metrics`). Each span and counter increment can
+also be appended to a rotating JSONL file; writing happens on a background thread so the
+hot path never waits on disk.
+"""
+import collections
+import functools
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels, **extra):
+    items = list(labels) + sorted(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in items) + "}"
+
+
+class Metrics:
+    """
+    Registry of timing summaries and counters, keyed by name and labels.
+
+    Summaries keep the most recent `max_samples` observations per label set for quantiles,
+    plus an all-time count and sum.
+    """
+
+    def __init__(self, prefix="rapidfire", max_samples=2048):
+        self.prefix = prefix
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._sums = collections.defaultdict(float)
+        self._counts = collections.defaultdict(int)
+        self._counters = collections.defaultdict(float)
+        self._events = None
+        self._listener = None
+
+    def enable_jsonl(self, path, max_bytes=10 * 2 ** 20, backup_count=5):
+        """
+        Also append every span and counter increment to a rotating JSONL file.
+
+        Parameters:
+        - path (str): Path of the JSONL file.
+        - max_bytes (int): Size at which the file is rotated.
+        - backup_count (int): Number of rotated files kept.
+        """
+        if self._listener is not None:
+            return
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        events = queue.Queue()
+        self._listener = logging.handlers.QueueListener(events, handler)
+        self._listener.start()
+        self._events = logging.getLogger(f"{__name__}.events.{id(self)}")
+        self._events.propagate = False
+        self._events.setLevel(logging.INFO)
+        self._events.addHandler(logging.handlers.QueueHandler(events))
+
+    def _log_event(self, kind, name, value, labels):
+        if self._events is not None:
+            self._events.info(json.dumps({"ts": time.time(), "kind": kind, "name": name, "value": value, **labels}))
+
+    def observe(self, name, seconds, **labels):
+        """Record one timing observation (in seconds)."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = collections.deque(maxlen=self.max_samples)
+            samples.append(seconds)
+            self._sums[key] += seconds
+            self._counts[key] += 1
+        self._log_event("span", name, seconds, labels)
+
+    def inc(self, name, amount=1, **labels):
+        """Increase a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += amount
+        self._log_event("counter", name, amount, labels)
+
+    @contextmanager
+    def span(self, name, **labels):
+        """
+        Time the enclosed block. The yielded dict can be updated inside the block to add labels
+        that are only known at the end (e.g. cache="hit"). Failed blocks get error="true".
+        """
+        started = time.perf_counter()
+        labels = dict(labels)
+        try:
+            yield labels
+        except BaseException:
+            labels["error"] = "true"
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, name, **labels):
+        """Decorator that times every call of a function as a span."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(name, **labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def quantiles(self):
+        """
+        Return {(name, labels): {"count", "p50", "p90", "p99"}} over the recent samples of every summary.
+        """
+        with self._lock:
+            snapshot = {key: (sorted(samples), self._counts[key]) for key, samples in self._samples.items()}
+        result = {}
+        for key, (samples, count) in snapshot.items():
+            result[key] = {"count": count}
+            for quantile in QUANTILES:
+                result[key][f"p{int(quantile * 100)}"] = samples[min(len(samples) - 1, int(len(samples) * quantile))]
+        return result
+
+    def render_prometheus(self):
+        """
+        Return all metrics in the Prometheus text exposition format.
+        """
+        quantiles = self.quantiles()
+        with self._lock:
+            sums = dict(self._sums)
+            counters = dict(self._counters)
+
+        lines = []
+        for name in sorted({name for name, _ in quantiles}):
+            metric = f"{self.prefix}_{name}_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for (series_name, labels), values in sorted(quantiles.items()):
+                if series_name != name:
+                    continue
+                for quantile in QUANTILES:
+                    value = values[f"p{int(quantile * 100)}"]
+                    lines.append(f"{metric}{_format_labels(labels, quantile=quantile)} {value}")
+                lines.append(f"{metric}_sum{_format_labels(labels)} {sums[(series_name, labels)]}")
+                lines.append(f"{metric}_count{_format_labels(labels)} {values['count']}")
+
+        for name in sorted({name for name, _ in counters}):
+            metric = f"{self.prefix}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for (series_name, labels), value in sorted(counters.items()):
+                if series_name == name:
+                    lines.append(f"{metric}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry shared by every session
+METRICS = Metrics()
+
+
+def start_metrics_server(port, host="127.0.0.1", metrics=METRICS):
+    """
+    Serve `metrics` in Prometheus text format at http://<host>:<port>/metrics on a background thread.
+
+    Returns:
+    - ThreadingHTTPServer: The running server.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            body = metrics.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
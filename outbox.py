@@ -0,0 +1,215 @@
+import os
+import smtplib
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from email import message_from_bytes, policy
+
+from metrics import METRICS
+from utils import open_smtp_connection
+
+# Delivery status of an email: "pending", "sent", "failed" or "unknown" (or "scheduled" for a report
+# waiting for its digest), the error of the last failed attempt, and the datetime a scheduled email is sent at.
+DeliveryStatus = namedtuple("DeliveryStatus", ["status", "last_error", "send_at"])
+
+
+class EmailOutbox:
+    """
+    Persistent outbox that sends emails from a background worker.
+
+    `enqueue` stores the serialized message in a local SQLite queue and returns immediately.
+    A single worker thread sends due messages in batches over one reused SMTP connection,
+    retries failures with exponential backoff, and picks up unsent messages again after
+    a restart.
+    """
+
+    def __init__(self, path, connect, batch_size=20, max_attempts=6, base_delay=5.0, max_delay=900.0,
+                 idle_timeout=60.0, poll_interval=5.0):
+        """
+        Parameters:
+        - path (str): Path to the SQLite queue file. It is created if it does not exist.
+        - connect (callable): Function returning a logged-in smtplib.SMTP connection.
+        - batch_size (int): Maximum number of messages sent per batch.
+        - max_attempts (int): Attempts before a message is marked as failed.
+        - base_delay (float), max_delay (float): Backoff in seconds is base_delay * 2 ** (attempts - 1), capped at max_delay.
+        - idle_timeout (float): Seconds without anything to send after which the SMTP connection is closed.
+        - poll_interval (float): Seconds between checks for messages whose retry time has come.
+        """
+        self._connect = connect
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self._smtp = None
+        self._last_used = 0.0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._worker = None
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY,
+                sender TEXT NOT NULL,
+                recipient TEXT NOT NULL,
+                message BLOB NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+        self._conn.commit()
+
+    def enqueue(self, message):
+        """
+        Queue a message for sending.
+
+        Parameters:
+        - message (email.message.EmailMessage): Message with From and To headers set.
+
+        Returns:
+        - int: Id of the queued message, for use with `status`.
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO outbox (sender, recipient, message, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                (message["From"], message["To"], message.as_bytes(), now, now)
+            )
+            self._conn.commit()
+        self._wake.set()
+        return cursor.lastrowid
+
+    def status(self, message_id):
+        """
+        Return the delivery status of a queued message.
+
+        Returns:
+        - DeliveryStatus: Its status is "pending", "sent", "failed" or "unknown".
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT status, last_error FROM outbox WHERE id = ?", (message_id,)).fetchone()
+        return DeliveryStatus(*row, send_at=None) if row else DeliveryStatus("unknown", None, None)
+
+    def start(self):
+        """Start the background worker if it is not already running."""
+        if self._worker is None or not self._worker.is_alive():
+            self._stop.clear()
+            self._worker = threading.Thread(target=self._run, name="email-outbox", daemon=True)
+            self._worker.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Stop the background worker and close the SMTP connection. Unsent messages stay queued."""
+        self._stop.set()
+        self._wake.set()
+        if self._worker is not None:
+            self._worker.join(timeout)
+        self._disconnect()
+
+    def send_due(self):
+        """
+        Send one batch of due messages over the shared connection.
+
+        Returns:
+        - int: Number of messages attempted.
+        """
+        with self._lock:
+            batch = self._conn.execute(
+                "SELECT id, sender, recipient, message, attempts FROM outbox "
+                "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (time.time(), self.batch_size)
+            ).fetchall()
+
+        for message_id, sender, recipient, raw_message, attempts in batch:
+            try:
+                self._send(sender, recipient, raw_message)
+            except Exception as e:
+                self._disconnect()
+                self._record_failure(message_id, attempts + 1, e)
+            else:
+                with self._lock:
+                    self._conn.execute("UPDATE outbox SET status = 'sent', attempts = ?, last_error = NULL WHERE id = ?",
+                                       (attempts + 1, message_id))
+                    self._conn.commit()
+        return len(batch)
+
+    def _send(self, sender, recipient, raw_message):
+        if self._smtp is None:
+            self._smtp = self._connect()
+        message = message_from_bytes(raw_message, policy=policy.SMTP)
+        with METRICS.span("send_email", via="outbox"):
+            try:
+                self._smtp.send_message(message, from_addr=sender, to_addrs=[recipient])
+            except smtplib.SMTPServerDisconnected:
+                # The server closed the idle connection; reconnect once and retry
+                self._smtp = self._connect()
+                self._smtp.send_message(message, from_addr=sender, to_addrs=[recipient])
+        self._last_used = time.monotonic()
+
+    def _record_failure(self, message_id, attempts, error):
+        status = "failed" if attempts >= self.max_attempts else "pending"
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (status, attempts, time.time() + delay, str(error), message_id)
+            )
+            self._conn.commit()
+
+    def _disconnect(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                pass
+            self._smtp = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                sent = self.send_due()
+            except Exception:
+                sent = 0
+            if sent:
+                continue
+            if self._smtp is not None and time.monotonic() - self._last_used > self.idle_timeout:
+                self._disconnect()
+            self._wake.wait(self.poll_interval)
+
+
+def open_email_outbox(settings, base_dir, email_password):
+    """
+    Open the outbox configured in settings.yaml and start its worker.
+
+    Parameters:
+    - settings (dict): Contents of settings.yaml.
+    - base_dir (str): Directory that a relative outbox_path is resolved against.
+    - email_password (str): Password for settings['sender_email'].
+
+    Returns:
+    - EmailOutbox: The running outbox.
+    """
+    def connect():
+        return open_smtp_connection(
+            settings['sender_email'], email_password,
+            host=settings.get('smtp_host', 'smtp.gmail.com'),
+            port=settings.get('smtp_port', 465),
+            use_ssl=settings.get('smtp_ssl', True)
+        )
+
+    outbox = EmailOutbox(
+        os.path.join(base_dir, settings.get('outbox_path', 'outbox.sqlite3')),
+        connect,
+        batch_size=settings.get('outbox_batch_size', 20),
+        max_attempts=settings.get('outbox_max_attempts', 6)
+    )
+    return outbox.start()
@@ -0,0 +1,69 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class EssayPrefetcher:
+    """
+    Speculatively generate Module 1 outputs in the background for a single session.
+
+    While the student reads and rates the current essay pair, the prompts for the
+    selections they are most likely to make next are generated on a small thread pool.
+    When the student clicks "Generate", a finished (or in-flight) speculation is used
+    instead of starting a new LLM call.
+    """
+
+    def __init__(self, generate, max_workers=2, max_speculations=4):
+        """
+        Parameters:
+        - generate (callable): Function taking a prompt and returning the Module 1 output. It runs
+          on worker threads, so it must not use Streamlit APIs.
+        - max_workers (int): Number of speculations that may run at the same time.
+        - max_speculations (int): Number of speculations that may be tracked (queued or running) at once.
+        """
+        self._generate = generate
+        self._max_speculations = max_speculations
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="essay-prefetch")
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def speculate(self, prompts):
+        """
+        Start generating the given prompts, most likely first, and cancel queued
+        speculations for prompts that are no longer wanted.
+
+        Calling this again with the same prompts is cheap, so it can be called on every rerun.
+
+        Parameters:
+        - prompts (list): Rendered Module 1 prompts (any hashable value), ordered from most to least likely.
+        """
+        wanted = prompts[:self._max_speculations]
+        with self._lock:
+            for prompt, future in list(self._futures.items()):
+                # Running speculations cannot be cancelled; they finish and warm the shared cache
+                if prompt not in wanted and (future.done() or future.cancel()):
+                    del self._futures[prompt]
+
+            for prompt in wanted:
+                if len(self._futures) >= self._max_speculations:
+                    break
+                if prompt not in self._futures:
+                    self._futures[prompt] = self._executor.submit(self._generate, prompt)
+
+    def take(self, prompt):
+        """
+        Stop tracking the speculation for a prompt and return it.
+
+        Returns:
+        - Future or None: The speculation, or None if the prompt was not speculated or it was cancelled.
+        """
+        with self._lock:
+            future = self._futures.pop(prompt, None)
+        if future is None or future.cancelled():
+            return None
+        return future
+
+    def shutdown(self):
+        """Cancel all queued speculations and release the worker threads."""
+        with self._lock:
+            self._futures.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,103 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import create_pdf
+
+
+class ReportDrafter:
+    """
+    Keeps a draft of the Module 3 counselor report up to date in the background.
+
+    The first draft is written from the whole brainstorm; later refreshes only send the
+    previous draft plus the turns since it was written (a delta update). Drafts are written
+    one at a time on a single worker, and at most one refresh is queued, so a fast-talking
+    student cannot pile up LLM calls. When the report is requested, only the turns after
+    the last draft (usually none) still have to be folded in.
+    """
+
+    def __init__(self, llm, transcript, report_suffix, update_template, refresh_every=6):
+        """
+        Parameters:
+        - llm (callable): Function taking a prompt and returning the LLM's response. Runs on a background thread.
+        - transcript (callable): Function taking a start index and returning the brainstorm messages from there on.
+          Runs on a background thread.
+        - report_suffix (str): Student info and module_three.txt, appended to the conversation for the first draft.
+        - update_template (str): Template with {report} and {turns} fields for delta updates.
+        - refresh_every (int): Number of new messages after which the draft is refreshed. 0 only drafts on request.
+        """
+        self._llm = llm
+        self._transcript = transcript
+        self._report_suffix = report_suffix
+        self._update_template = update_template
+        self.refresh_every = refresh_every
+        self.report = None
+        self.pdf_buffer = None
+        self._covered = 0  # number of messages the current draft covers
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="report-draft")
+        self._queued = None
+        self._lock = threading.Lock()
+
+    def refresh(self, memory, final=False):
+        """
+        Queue a background refresh of the draft if enough of the conversation is new.
+
+        Parameters:
+        - memory (ConversationMemory): The brainstorm conversation.
+        - final (bool): Refresh regardless of refresh_every, e.g. once the topic is identified.
+
+        Returns:
+        - Future or None: The queued refresh, if any.
+        """
+        with self._lock:
+            new_messages = memory.count - self._covered
+            due = final or (self.refresh_every and new_messages >= self.refresh_every)
+            if new_messages <= 0 or not due:
+                return self._queued
+            # A refresh that has not started yet will already see the latest messages
+            if self._queued is None or self._queued.running() or self._queued.done():
+                self._queued = self._executor.submit(self._draft, memory)
+            return self._queued
+
+    def result(self, memory):
+        """
+        Return the report covering the whole conversation, waiting for the final update if needed.
+
+        Returns:
+        - tuple: (report text, PDF as io.BytesIO).
+        """
+        future = self.refresh(memory, final=True)
+        if future is not None:
+            try:
+                future.result()
+            except Exception:
+                pass  # retried below, on this thread
+        # Fold in anything the background drafts did not cover (or failed to)
+        if self._covered < memory.count:
+            self._draft(memory)
+        return self.report, self.pdf_buffer
+
+    def _draft(self, memory):
+        covered = self._covered
+        messages = self._transcript(covered)
+        if not messages:
+            return
+
+        if self.report is None:
+            # The whole brainstorm, not the summarized and budget-trimmed chat prompt
+            report = self._llm(memory.render(suffix=self._report_suffix, history=messages))
+        else:
+            turns = "\n\n".join(
+                f"Student: {message['content']}" if message["role"] == "user" else message["content"]
+                for message in messages
+            )
+            report = self._llm(self._update_template.format(report=self.report, turns=turns))
+
+        pdf_buffer = create_pdf(report)
+        with self._lock:
+            self.report = report
+            self.pdf_buffer = pdf_buffer
+            self._covered = covered + len(messages)
+
+    def shutdown(self):
+        """Release the worker thread once the report is no longer needed."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,280 @@
+"""
+PDF rendering of Statement Starter Reports.
+
+Reports are laid out from the markdown-like structure the LLM writes (headings, bullet and
+numbered outlines, **bold** labels) on a shared page template, and rendered PDFs are kept in
+a size-bounded cache keyed by a hash of their content, so regenerating an unchanged report
+(or re-sending it) does not render it again.
+"""
+import collections
+import hashlib
+import re
+import threading
+
+from metrics import METRICS
+
+# The core PDF fonts only cover Latin-1, but LLM output often uses typographic punctuation
+_PUNCTUATION = str.maketrans({
+    "\u2018": "'", "\u2019": "'", "\u201c": '"', "\u201d": '"', "\u2013": "-", "\u2014": "-",
+    "\u2026": "...", "\u2022": "\u00b7", "\u00a0": " ",
+})
+
+_HEADING = re.compile(r"^(#{1,6})\s+(.*)$")
+_BULLET = re.compile(r"^(\s*)[-*+]\s+(.*)$")
+_NUMBERED = re.compile(r"^(\s*)(\d+|[a-zA-Z])[.)]\s+(.*)$")
+_RULE = re.compile(r"^\s*([-*_])(\s*\1){2,}\s*$")
+
+
+def to_latin1(text):
+    """Replace characters the core PDF fonts cannot show."""
+    return text.translate(_PUNCTUATION).encode("latin-1", "replace").decode("latin-1")
+
+
+class ReportTemplate:
+    """
+    Page setup and text styles shared by every report.
+    """
+
+    def __init__(self, font="Helvetica", body_size=11, heading_sizes=(16, 14, 12), line_height=1.45, margin=18,
+                 indent=6):
+        """
+        Parameters:
+        - font (str): Core PDF font family.
+        - body_size (int): Font size of body text, in points.
+        - heading_sizes (tuple): Font sizes of level 1, 2 and 3+ headings.
+        - line_height (float): Line height as a multiple of the font size.
+        - margin (float): Page margins in millimeters.
+        - indent (float): Indentation per outline level in millimeters.
+        """
+        self.font = font
+        self.body_size = body_size
+        self.heading_sizes = heading_sizes
+        self.line_height = line_height
+        self.margin = margin
+        self.indent = indent
+
+        # Width of each word per (style, size), reused by every document rendered with this template.
+        # Words are measured on a scratch document so the fonts of the real one are left alone.
+        self._widths = {}
+        self._scratch = None
+        self._scratch_lock = threading.Lock()
+
+    def line_height_mm(self, size):
+        return size * self.line_height * 0.3528  # points to millimeters
+
+    def new_document(self):
+        """Return an empty document with the page setup and body font applied."""
+        from fpdf import FPDF  # imported on first use, as it is slow to import and only needed for reports
+        pdf = FPDF()
+        pdf.set_margins(self.margin, self.margin)
+        pdf.set_auto_page_break(True, self.margin)
+        pdf.add_page()
+        pdf.set_font(self.font, size=self.body_size)
+        return pdf
+
+    def _width(self, word, style, size):
+        key = (style, size, word)
+        width = self._widths.get(key)
+        if width is None:
+            with self._scratch_lock:
+                if self._scratch is None:
+                    from fpdf import FPDF
+                    self._scratch = FPDF()
+                if len(self._widths) > 100000:
+                    self._widths.clear()
+                self._scratch.set_font(self.font, style, size)
+                width = self._widths[key] = self._scratch.get_string_width(word)
+        return width
+
+    def write(self, pdf, text, size, x, bold=False):
+        """
+        Write a paragraph starting at x, wrapped to the right margin. **Bold** runs are honored.
+
+        Lines are broken on word widths cached in the template and written with one cell per
+        run, which is much cheaper than fpdf2's character-by-character multi_cell.
+        """
+        parts = text.split("**")
+        if len(parts) % 2 == 0:
+            parts = [text]  # unbalanced markers are shown as they are
+        words = []  # (style, word, width of the word, width of a preceding space)
+        for i, part in enumerate(parts):
+            style = "B" if bold or i % 2 else ""
+            space = self._width(" ", style, size)
+            for word in part.split():
+                words.append((style, word, self._width(word, style, size), space))
+
+        height = self.line_height_mm(size)
+        max_width = pdf.w - pdf.r_margin - x
+        lines, line, used = [], [], 0.0
+        for style, word, width, space in words:
+            gap = space if line else 0.0
+            if line and used + gap + width > max_width:
+                lines.append(line)
+                line, used, gap = [], 0.0, 0.0
+            line.append((style, word, gap))
+            used += gap + width
+
+        if line or not lines:
+            lines.append(line)
+        for line in lines:
+            # Merge consecutive words of the same style into one cell
+            runs = []
+            for style, word, gap in line:
+                if runs and runs[-1][0] == style:
+                    runs[-1][1] += " " + word
+                else:
+                    runs.append([style, (" " if gap else "") + word])
+            if pdf.will_page_break(height):
+                pdf.add_page()
+            pdf.set_x(x)
+            for style, run in runs:
+                pdf.set_font(self.font, style, size)
+                pdf.cell(txt=run, h=height, new_x="RIGHT", new_y="TOP")
+            pdf.ln(height)
+        pdf.set_font(self.font, size=self.body_size)
+
+    def heading(self, pdf, text, level):
+        size = self.heading_sizes[min(level, len(self.heading_sizes)) - 1]
+        pdf.ln(self.line_height_mm(self.body_size) * 0.4)
+        self.write(pdf, text, size, pdf.l_margin, bold=True)
+
+    def paragraph(self, pdf, text, indent_level=0, marker=None):
+        x = pdf.l_margin + indent_level * self.indent
+        if marker:
+            if pdf.will_page_break(self.line_height_mm(self.body_size)):
+                pdf.add_page()
+            pdf.set_xy(x, pdf.get_y())
+            pdf.cell(txt=marker, h=self.line_height_mm(self.body_size), new_x="RIGHT", new_y="TOP")
+            x += self.indent
+            pdf.set_x(x)
+        self.write(pdf, text, self.body_size, x)
+
+    def layout(self, pdf, text):
+        """Write markdown-like report text into the document."""
+        blank = 0
+        for line in to_latin1(text).splitlines():
+            stripped = line.strip()
+            if not stripped:
+                blank += 1
+                if blank == 1:
+                    pdf.ln(self.line_height_mm(self.body_size) * 0.5)
+                continue
+            blank = 0
+
+            match = _HEADING.match(stripped)
+            if match:
+                self.heading(pdf, match.group(2).strip("*# "), len(match.group(1)))
+                continue
+            if _RULE.match(stripped):
+                y = pdf.get_y() + 1
+                pdf.line(pdf.l_margin, y, pdf.w - pdf.r_margin, y)
+                pdf.ln(3)
+                continue
+            match = _BULLET.match(line)
+            if match:
+                level = 1 + len(match.group(1).expandtabs(4)) // 2
+                self.paragraph(pdf, match.group(2), indent_level=level - 1, marker="\u00b7")
+                continue
+            match = _NUMBERED.match(line)
+            if match:
+                level = 1 + len(match.group(1).expandtabs(4)) // 2
+                self.paragraph(pdf, match.group(3), indent_level=level - 1, marker=f"{match.group(2)}.")
+                continue
+            self.paragraph(pdf, stripped)
+
+
+class ReportRenderer:
+    """
+    Renders reports to PDF bytes with an LRU cache bounded by the total size of the cached PDFs.
+    Safe to share between sessions and threads.
+    """
+
+    def __init__(self, template=None, cache_max_bytes=32 * 2 ** 20):
+        """
+        Parameters:
+        - template (ReportTemplate): Page setup and styles. Defaults to ReportTemplate().
+        - cache_max_bytes (int): Maximum total size of cached PDFs. 0 disables the cache.
+        """
+        self.template = template or ReportTemplate()
+        self.cache_max_bytes = cache_max_bytes
+        self._cache = collections.OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+
+    def _cached(self, key, render):
+        with self._lock:
+            pdf_bytes = self._cache.get(key)
+            if pdf_bytes is not None:
+                self._cache.move_to_end(key)
+        if pdf_bytes is not None:
+            METRICS.inc("pdf_cache_requests", result="hit")
+            return pdf_bytes
+
+        METRICS.inc("pdf_cache_requests", result="miss")
+        pdf_bytes = self._render(render)
+        with self._lock:
+            if key not in self._cache and len(pdf_bytes) <= self.cache_max_bytes:
+                self._cache[key] = pdf_bytes
+                self._cache_bytes += len(pdf_bytes)
+                while self._cache_bytes > self.cache_max_bytes:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cache_bytes -= len(evicted)
+        return pdf_bytes
+
+    @staticmethod
+    def _render(build):
+        with METRICS.span("render_pdf"):
+            return bytes(build().output())
+
+    def render(self, text):
+        """
+        Render one report.
+
+        Returns:
+        - bytes: The PDF.
+        """
+        def render():
+            pdf = self.template.new_document()
+            self.template.layout(pdf, text)
+            return pdf
+        return self._cached(hashlib.sha256(text.encode("utf-8")).hexdigest(), render)
+
+    def render_many(self, title, reports):
+        """
+        Render several reports into one PDF: an index page listing them, then each report on its own pages.
+        Not cached, as each digest is only rendered once.
+
+        Parameters:
+        - title (str): Heading of the index page.
+        - reports (list): (heading, text) tuples, in index order.
+
+        Returns:
+        - bytes: The PDF.
+        """
+        def render():
+            template = self.template
+            pdf = template.new_document()
+            template.heading(pdf, to_latin1(title), 1)
+            for i, (heading, _) in enumerate(reports, 1):
+                template.paragraph(pdf, to_latin1(heading), marker=f"{i}.")
+            for i, (heading, text) in enumerate(reports, 1):
+                pdf.add_page()
+                template.heading(pdf, to_latin1(f"{i}. {heading}"), 2)
+                template.layout(pdf, text)
+            return pdf
+        return self._render(render)
+
+    def clear(self):
+        """Empty the cache."""
+        with self._lock:
+            self._cache.clear()
+            self._cache_bytes = 0
+
+    def cache_info(self):
+        """Return (number of cached PDFs, their total size in bytes)."""
+        with self._lock:
+            return len(self._cache), self._cache_bytes
+
+
+# Process-wide renderer shared by every session
+REPORT_RENDERER = ReportRenderer()
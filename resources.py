@@ -0,0 +1,118 @@
+"""
+Process-wide resources shared by every session and rerun of main.py.
+
+Streamlit re-executes main.py on every interaction, so settings, prompt files, templates
+and the chat clients (behind their gateways) are cached with st.cache_resource instead of being rebuilt each time.
+File-backed resources are keyed on the file's modification time, so editing a prompt or
+settings.yaml takes effect on the next rerun without restarting the app.
+"""
+import os
+import time
+
+import streamlit as st
+from streamlit.logger import get_logger
+from gateway import open_llm_gateway
+from metrics import METRICS
+from utils import ChatPromptTemplate, load_data, load_api_key_from_file, load_LLM, load_file_to_list, load_yaml_settings
+
+logger = get_logger(__name__)
+
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def _load_settings(filename, mtime):
+    return load_yaml_settings(filename)
+
+@st.cache_resource(max_entries=64, show_spinner=False)
+def _load_text(filename, mtime):
+    return load_data(filename)
+
+@st.cache_resource(max_entries=64, show_spinner=False)
+def _load_list(filename, mtime):
+    return load_file_to_list(filename)
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def _load_prompt_template(filename, mtime):
+    return ChatPromptTemplate(load_data(filename))
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def _load_api_config(filename, mtime):
+    return load_api_key_from_file(filename)
+
+def get_settings(filename):
+    """
+    Return the contents of a YAML settings file, re-read only when the file changes.
+    The returned dict is shared between sessions and must not be modified.
+    """
+    return _load_settings(filename, os.path.getmtime(filename))
+
+def get_text(filename):
+    """
+    Return the stripped contents of a text file, re-read only when the file changes.
+    """
+    return _load_text(filename, os.path.getmtime(filename))
+
+def get_list(filename):
+    """
+    Return the lines of a text file as a list, re-read only when the file changes.
+    The returned list is shared between sessions and must not be modified.
+    """
+    return _load_list(filename, os.path.getmtime(filename))
+
+def get_prompt_template(filename):
+    """
+    Return a ChatPromptTemplate for a prompt file, rebuilt only when the file changes.
+    """
+    return _load_prompt_template(filename, os.path.getmtime(filename))
+
+def get_api_config(filename):
+    """
+    Return the keys in a config.txt file, re-read only when the file changes.
+    """
+    return _load_api_config(filename, os.path.getmtime(filename))
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def get_llm(key, settings, model="gpt-4"):
+    """
+    Return the chat client for an API key and model behind its own LLMGateway, constructed once per process.
+    Each model gets its own gateway because OpenAI rate limits are per model. settings['llm_client']
+    selects the OpenAI API ("openai") or a local stub ("stub").
+    """
+    def chat_client(model):
+        return load_LLM(key, model=model, api_base=settings.get('openai_api_base'),
+                        client=settings.get('llm_client', 'openai'))
+
+    fallback_model = settings.get('llm_fallback_model')
+    fallback_llm = None
+    if fallback_model and fallback_model != model:
+        fallback_llm = chat_client(fallback_model)
+    return open_llm_gateway(chat_client(model), settings, fallback_llm=fallback_llm)
+
+
+class RerunTimer:
+    """
+    Measures how long one execution of main.py takes, split into named stages.
+    """
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._last = self._start
+        self.stages = []
+
+    def mark(self, stage):
+        """Record the time spent since the previous mark under the given stage name."""
+        now = time.perf_counter()
+        self.stages.append((stage, (now - self._last) * 1000))
+        self._last = now
+
+    def finish(self, page):
+        """
+        Log the rerun's timing and record it in the metrics under the page that was shown.
+
+        Returns:
+        - float: Total time of the rerun in milliseconds.
+        """
+        total_ms = (time.perf_counter() - self._start) * 1000
+        stages = ", ".join(f"{stage}={ms:.1f}ms" for stage, ms in self.stages)
+        logger.info("Rerun of %s took %.1fms (%s)", page, total_ms, stages)
+        METRICS.observe("rerun", total_ms / 1000, page=page)
+        return total_ms
@@ -0,0 +1,189 @@
+import collections
+import threading
+import time
+from concurrent.futures import TimeoutError
+from contextlib import contextmanager
+
+from metrics import METRICS
+
+# Lower value = served first. Chat turns are interactive, Module 1 essays are slower to
+# read anyway, and background work (prefetching, summaries, report drafts) can wait.
+PRIORITIES = {"chat": 0, "essay": 1, "background": 2}
+
+
+class _Ticket:
+    def __init__(self, session, priority):
+        self.session = session
+        self.priority = priority
+        self.enqueued_at = time.perf_counter()
+        self.admitted = threading.Event()
+
+
+class LLMScheduler:
+    """
+    Admission control for LLM work shared by every session in the process.
+
+    At most `max_concurrency` jobs hold a slot at once. Jobs that do not get a slot wait in
+    one queue per priority; within a priority, sessions are served round-robin, so a
+    student with several queued jobs cannot delay everyone else. Waiting callers get their
+    queue position and an estimated wait, based on how long recent jobs held their slot.
+    """
+
+    def __init__(self, max_concurrency=8, poll_interval=0.5, initial_service_seconds=10.0):
+        """
+        Parameters:
+        - max_concurrency (int): Number of jobs that may run at the same time.
+        - poll_interval (float): Seconds between on_wait updates while waiting.
+        - initial_service_seconds (float): Assumed job duration until real durations have been seen.
+        """
+        self.max_concurrency = max_concurrency
+        self.poll_interval = poll_interval
+        self._service_seconds = initial_service_seconds
+        self._active = 0
+        # One queue per priority: session -> tickets, in round-robin order
+        self._queues = [collections.OrderedDict() for _ in PRIORITIES]
+        self._lock = threading.Lock()
+
+    def _enqueue(self, ticket):
+        queue = self._queues[ticket.priority]
+        if ticket.session not in queue:
+            queue[ticket.session] = collections.deque()
+        queue[ticket.session].append(ticket)
+
+    def _remove(self, ticket):
+        tickets = self._queues[ticket.priority].get(ticket.session)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del self._queues[ticket.priority][ticket.session]
+
+    def _dispatch(self):
+        # Called with the lock held
+        for queue in self._queues:
+            while queue and self._active < self.max_concurrency:
+                session, tickets = next(iter(queue.items()))
+                ticket = tickets.popleft()
+                if tickets:
+                    queue.move_to_end(session)
+                else:
+                    del queue[session]
+                self._active += 1
+                ticket.admitted.set()
+
+    def _position(self, ticket):
+        # Number of queued jobs that will be admitted before the ticket, following the round-robin order
+        ahead = sum(len(tickets) for queue in self._queues[:ticket.priority] for tickets in queue.values())
+        queue = self._queues[ticket.priority]
+        index = queue[ticket.session].index(ticket)
+        before = True
+        for session, tickets in queue.items():
+            if session == ticket.session:
+                ahead += index
+                before = False
+            else:
+                ahead += min(len(tickets), index + 1 if before else index)
+        return ahead
+
+    def _eta(self, position):
+        return (position // self.max_concurrency + 1) * self._service_seconds
+
+    def _status(self, session):
+        # Best queue position among the session's waiting jobs
+        positions = [self._position(ticket) for queue in self._queues for ticket in queue.get(session, ())]
+        if not positions:
+            return None
+        position = min(positions)
+        return position, self._eta(position)
+
+    def status(self, session):
+        """
+        Return (jobs ahead, estimated seconds until admitted) for the session's first waiting job,
+        or None if it has nothing queued.
+        """
+        with self._lock:
+            return self._status(session)
+
+    def promote(self, session, priority):
+        """
+        Raise the session's queued jobs to at least `priority`, e.g. once the student is waiting on them.
+        """
+        level = PRIORITIES[priority]
+        with self._lock:
+            for queue in self._queues[level + 1:]:
+                for ticket in list(queue.get(session, ())):
+                    self._remove(ticket)
+                    ticket.priority = level
+                    self._enqueue(ticket)
+
+    @contextmanager
+    def slot(self, session, priority, on_wait=None):
+        """
+        Hold one of the slots while the enclosed block runs, waiting in the queue first if needed.
+
+        Parameters:
+        - session (str): The student the work is for.
+        - priority (str): A key of PRIORITIES.
+        - on_wait (callable): Called with (jobs ahead, estimated seconds) every poll_interval while
+          waiting. It runs on the waiting thread.
+        """
+        ticket = _Ticket(session, PRIORITIES[priority])
+        with self._lock:
+            self._enqueue(ticket)
+            self._dispatch()
+        try:
+            while not ticket.admitted.wait(self.poll_interval):
+                if on_wait is not None:
+                    with self._lock:
+                        position = None if ticket.admitted.is_set() else self._position(ticket)
+                    if position is not None:
+                        on_wait(position, self._eta(position))
+        except BaseException:
+            # E.g. Streamlit stopped the script while it was waiting: leave the queue
+            with self._lock:
+                admitted = ticket.admitted.is_set()
+                if not admitted:
+                    self._remove(ticket)
+            if admitted:
+                self._release()
+            raise
+
+        admitted_at = time.perf_counter()
+        METRICS.observe("llm_queue_wait", admitted_at - ticket.enqueued_at, priority=priority)
+        try:
+            yield
+        finally:
+            with self._lock:
+                # Exponentially weighted average of how long a job holds its slot
+                self._service_seconds += 0.2 * (time.perf_counter() - admitted_at - self._service_seconds)
+            self._release()
+
+    def _release(self):
+        with self._lock:
+            self._active -= 1
+            self._dispatch()
+
+    def wrap(self, fn, session, priority):
+        """
+        Return a function that runs `fn` in a slot of the given priority, for background work.
+        """
+        def scheduled(*args, **kwargs):
+            with self.slot(session, priority):
+                return fn(*args, **kwargs)
+        return scheduled
+
+    def wait(self, future, session, priority, on_wait=None):
+        """
+        Wait for a future whose work runs in the session's slots (e.g. a prefetch), promoting the
+        session's queued jobs to `priority` and reporting their queue position while waiting.
+
+        Returns:
+        - The future's result.
+        """
+        while True:
+            self.promote(session, priority)
+            try:
+                return future.result(timeout=self.poll_interval)
+            except TimeoutError:
+                status = self.status(session)
+                if status is not None and on_wait is not None:
+                    on_wait(*status)
@@ -0,0 +1,205 @@
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+
+class SessionStore:
+    """
+    Disk-backed store of student sessions keyed by a session token.
+
+    Each session has a small JSON `state` (form fields, progress flags, ratings), any
+    number of named artifacts (essays, the report PDF) stored as text or bytes, and the
+    brainstorm transcript, one row per message so adding a turn does not rewrite it. Pages
+    only keep the token and small values in `st.session_state` and read artifacts when they
+    are shown, so memory does not grow with every transcript and PDF, and progress survives
+    a page reload or a server restart. Sessions that have not been used for
+    `idle_ttl_seconds`, and the least recently used sessions beyond `max_sessions`, are evicted.
+    """
+
+    def __init__(self, path, idle_ttl_seconds=14 * 24 * 3600, max_sessions=5000, evict_interval=600.0):
+        """
+        Parameters:
+        - path (str): Path to the SQLite database file. It is created if it does not exist.
+        - idle_ttl_seconds (float): Time since last use after which a session is evicted. None disables expiry.
+        - max_sessions (int): Maximum number of stored sessions. None disables the limit.
+        - evict_interval (float): Minimum seconds between eviction passes.
+        """
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_sessions = max_sessions
+        self.evict_interval = evict_interval
+        self._last_evicted = 0.0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                token TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS artifacts (
+                token TEXT NOT NULL REFERENCES sessions (token) ON DELETE CASCADE,
+                name TEXT NOT NULL,
+                value BLOB NOT NULL,
+                PRIMARY KEY (token, name)
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                token TEXT NOT NULL REFERENCES sessions (token) ON DELETE CASCADE,
+                position INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                PRIMARY KEY (token, position)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_last_used ON sessions (last_used)")
+        self._conn.commit()
+        self.evict()
+
+    @staticmethod
+    def new_token():
+        """Return a new, unguessable session token."""
+        return secrets.token_urlsafe(16)
+
+    def load(self, token):
+        """
+        Return the saved state of a session and mark it as used.
+
+        Returns:
+        - dict or None: The state passed to the last `save`, or None if the session is unknown or evicted.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT state FROM sessions WHERE token = ?", (token,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE sessions SET last_used = ? WHERE token = ?", (time.time(), token))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def save(self, token, state):
+        """
+        Create or replace the small state of a session.
+
+        Parameters:
+        - token (str): Session token.
+        - state (dict): JSON-serializable values.
+        """
+        with self._lock:
+            self._conn.execute("""
+                INSERT INTO sessions (token, state, last_used) VALUES (?, ?, ?)
+                ON CONFLICT (token) DO UPDATE SET state = excluded.state, last_used = excluded.last_used
+            """, (token, json.dumps(state), time.time()))
+            self._conn.commit()
+        if time.time() - self._last_evicted > self.evict_interval:
+            self.evict()
+
+    def put_artifact(self, token, name, value):
+        """
+        Store a large value for a session, replacing any previous value under the same name.
+        The session must have been saved first.
+
+        Parameters:
+        - token (str): Session token.
+        - name (str): Artifact name, e.g. "strong_essay" or "report_pdf".
+        - value (str or bytes): The artifact. It is returned with the same type.
+        """
+        with self._lock:
+            self._conn.execute("UPDATE sessions SET last_used = ? WHERE token = ?", (time.time(), token))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO artifacts (token, name, value) VALUES (?, ?, ?)",
+                (token, name, value)
+            )
+            self._conn.commit()
+
+    def get_artifact(self, token, name, default=None):
+        """
+        Return a stored artifact, or `default` if there is none.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM artifacts WHERE token = ? AND name = ?", (token, name)
+            ).fetchone()
+        return row[0] if row else default
+
+    def append_message(self, token, role, content):
+        """
+        Append a message to a session's transcript. The session must have been saved first.
+
+        Parameters:
+        - token (str): Session token.
+        - role (str): "user" or "assistant".
+        - content (str): Text of the message.
+        """
+        with self._lock:
+            self._conn.execute("UPDATE sessions SET last_used = ? WHERE token = ?", (time.time(), token))
+            self._conn.execute("""
+                INSERT INTO messages (token, position, role, content)
+                SELECT ?, COALESCE(MAX(position) + 1, 0), ?, ? FROM messages WHERE token = ?
+            """, (token, role, content, token))
+            self._conn.commit()
+
+    def get_messages(self, token, start=0):
+        """
+        Return a session's transcript from message `start` on, as a list of {"role", "content"} dicts.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT role, content FROM messages WHERE token = ? AND position >= ? ORDER BY position",
+                (token, start)
+            ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def evict(self):
+        """
+        Delete idle sessions and the least recently used sessions beyond max_sessions.
+
+        Returns:
+        - int: Number of sessions deleted.
+        """
+        now = time.time()
+        with self._lock:
+            self._last_evicted = now
+            deleted = 0
+            if self.idle_ttl_seconds:
+                deleted += self._conn.execute(
+                    "DELETE FROM sessions WHERE last_used < ?", (now - self.idle_ttl_seconds,)
+                ).rowcount
+            if self.max_sessions:
+                (count,) = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()
+                if count > self.max_sessions:
+                    deleted += self._conn.execute(
+                        "DELETE FROM sessions WHERE token IN (SELECT token FROM sessions ORDER BY last_used LIMIT ?)",
+                        (count - self.max_sessions,)
+                    ).rowcount
+            self._conn.commit()
+        return deleted
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def open_session_store(settings, base_dir):
+    """
+    Open the session store configured in settings.yaml.
+
+    Parameters:
+    - settings (dict): Contents of settings.yaml.
+    - base_dir (str): Directory that a relative session_store_path is resolved against.
+
+    Returns:
+    - SessionStore: The opened store.
+    """
+    idle_days = settings.get('session_idle_days', 14)
+    return SessionStore(
+        os.path.join(base_dir, settings.get('session_store_path', 'sessions.sqlite3')),
+        idle_ttl_seconds=idle_days * 24 * 3600 if idle_days else None,
+        max_sessions=settings.get('session_max_count', 5000)
+    )
@@ -0,0 +1,299 @@
+"""
+Token accounting for LLM calls, with per-session and per-day budgets.
+
+Every call made through a MeteredLLM is counted with a local tokenizer and added to the
+student's session and to the day's total in a SQLite ledger. `plan` turns the usage into a
+BudgetPlan that tells the page how to degrade as a student (or the whole app) nears its
+budget, so one chatty student cannot run up unbounded cost and latency for everyone.
+
+Administrators can inspect usage and raise a session's budget from the command line:
+
+    python token_ledger.py [--day 2026-01-31] [--top 20]
+    python token_ledger.py --set-budget <session token> 400000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from metrics import METRICS
+from utils import count_tokens
+
+# How the next LLM call of a session should be degraded. `used` is the larger of the session's
+# and the day's usage as a fraction of its budget; each flag turns on at its threshold.
+BudgetPlan = namedtuple("BudgetPlan", ["used", "compress", "shorten", "downgrade", "exhausted"])
+
+
+class MeteredLLM:
+    """
+    Wraps an LLM (or LLMGateway) so every call is recorded in a TokenLedger under a session.
+    Called like the wrapped LLM (`llm(prompt)`, `llm.stream(prompt)`).
+    """
+
+    def __init__(self, llm, ledger, session):
+        self.llm = llm
+        self.ledger = ledger
+        self.session = session
+        # A gateway exposes the model of the LLM it wraps
+        self.model_name = getattr(llm, "model_name", None) or getattr(getattr(llm, "llm", None), "model_name", "unknown")
+
+    def __call__(self, prompt, **kwargs):
+        response = self.llm(prompt, **kwargs)
+        self.ledger.record(self.session, self.model_name, prompt, response)
+        return response
+
+    def stream(self, prompt, **kwargs):
+        response = ""
+        try:
+            for chunk in self.llm.stream(prompt, **kwargs):
+                response += chunk
+                yield chunk
+        finally:
+            # A stream that was abandoned part way was still paid for
+            self.ledger.record(self.session, self.model_name, prompt, response)
+
+
+class TokenLedger:
+    """
+    Disk-backed ledger of prompt and completion tokens per session, day and model.
+
+    Session budgets apply to a session's whole lifetime; the daily budget to all sessions together
+    on one calendar day (server local time). A session's budget can be overridden by an
+    administrator; the override is stored in the ledger.
+    """
+
+    def __init__(self, path, session_budget=200000, daily_budget=5000000, compress_at=0.5, shorten_at=0.75,
+                 downgrade_at=0.9, retention_days=90, evict_interval=3600.0):
+        """
+        Parameters:
+        - path (str): Path to the SQLite database file. It is created if it does not exist.
+        - session_budget (int): Default tokens per session. 0 or None disables the limit.
+        - daily_budget (int): Tokens per day across all sessions. 0 or None disables the limit.
+        - compress_at (float), shorten_at (float), downgrade_at (float): Fractions of a budget at which
+          the BudgetPlan asks for a compressed preamble, a shorter history and the cheaper model.
+        - retention_days (int): Per-session usage older than this is deleted. Daily totals are kept.
+        - evict_interval (float): Minimum seconds between deletions of old usage.
+        """
+        self.session_budget = session_budget
+        self.daily_budget = daily_budget
+        self.compress_at = compress_at
+        self.shorten_at = shorten_at
+        self.downgrade_at = downgrade_at
+        self.retention_days = retention_days
+        self.evict_interval = evict_interval
+        self._last_evicted = 0.0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS session_usage (
+                token TEXT NOT NULL,
+                day TEXT NOT NULL,
+                model TEXT NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                completion_tokens INTEGER NOT NULL,
+                calls INTEGER NOT NULL,
+                PRIMARY KEY (token, day, model)
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS daily_usage (
+                day TEXT NOT NULL,
+                model TEXT NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                completion_tokens INTEGER NOT NULL,
+                calls INTEGER NOT NULL,
+                PRIMARY KEY (day, model)
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS session_budgets (
+                token TEXT PRIMARY KEY,
+                tokens INTEGER NOT NULL,
+                set_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS session_usage_day ON session_usage (day)")
+        self._conn.commit()
+        self.evict()
+
+    @staticmethod
+    def today():
+        return time.strftime("%Y-%m-%d")
+
+    def meter(self, llm, session):
+        """Return a MeteredLLM recording the calls made through llm under session."""
+        return MeteredLLM(llm, self, session)
+
+    def record(self, session, model, prompt, response):
+        """
+        Count the tokens of one call and add them to the session's and the day's usage.
+
+        Returns:
+        - tuple: (prompt tokens, completion tokens).
+        """
+        prompt_tokens, completion_tokens = count_tokens(prompt), count_tokens(response)
+        values = (prompt_tokens, completion_tokens)
+        day = self.today()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO session_usage VALUES (?, ?, ?, ?, ?, 1) ON CONFLICT (token, day, model) DO UPDATE SET "
+                "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "completion_tokens = completion_tokens + excluded.completion_tokens, calls = calls + 1",
+                (session, day, model) + values
+            )
+            self._conn.execute(
+                "INSERT INTO daily_usage VALUES (?, ?, ?, ?, 1) ON CONFLICT (day, model) DO UPDATE SET "
+                "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "completion_tokens = completion_tokens + excluded.completion_tokens, calls = calls + 1",
+                (day, model) + values
+            )
+            self._conn.commit()
+        METRICS.inc("ledger_tokens", prompt_tokens + completion_tokens, model=model)
+        if time.time() - self._last_evicted > self.evict_interval:
+            self.evict()
+        return values
+
+    def usage(self, session):
+        """
+        Return (tokens used by the session, tokens used today by all sessions).
+        """
+        with self._lock:
+            session_used = self._conn.execute(
+                "SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0) FROM session_usage WHERE token = ?",
+                (session,)
+            ).fetchone()[0]
+            day_used = self._conn.execute(
+                "SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0) FROM daily_usage WHERE day = ?",
+                (self.today(),)
+            ).fetchone()[0]
+        return session_used, day_used
+
+    def budget(self, session):
+        """Return the session's token budget: its override if an administrator set one, else the default."""
+        with self._lock:
+            row = self._conn.execute("SELECT tokens FROM session_budgets WHERE token = ?", (session,)).fetchone()
+        return row[0] if row else self.session_budget
+
+    def set_budget(self, session, tokens):
+        """Override the token budget of one session."""
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO session_budgets VALUES (?, ?, ?)", (session, tokens, time.time()))
+            self._conn.commit()
+
+    def plan(self, session):
+        """
+        Return the BudgetPlan for the session's next call, from its usage and today's.
+        """
+        session_used, day_used = self.usage(session)
+        session_budget = self.budget(session)
+        used = max(session_used / session_budget if session_budget else 0.0,
+                   day_used / self.daily_budget if self.daily_budget else 0.0)
+        return BudgetPlan(used, compress=used >= self.compress_at, shorten=used >= self.shorten_at,
+                          downgrade=used >= self.downgrade_at, exhausted=used >= 1.0)
+
+    def report(self, day=None, top=20):
+        """
+        Summarize a day's usage for administrators.
+
+        Returns:
+        - tuple: (list of (model, prompt tokens, completion tokens, calls) for the day,
+          list of (session, tokens that day, tokens in total, budget) for its heaviest sessions).
+        """
+        day = day or self.today()
+        with self._lock:
+            models = self._conn.execute(
+                "SELECT model, prompt_tokens, completion_tokens, calls FROM daily_usage WHERE day = ? ORDER BY model",
+                (day,)
+            ).fetchall()
+            sessions = self._conn.execute(
+                "SELECT u.token, SUM(u.prompt_tokens + u.completion_tokens) AS day_tokens, "
+                "(SELECT SUM(prompt_tokens + completion_tokens) FROM session_usage WHERE token = u.token), "
+                "b.tokens FROM session_usage u LEFT JOIN session_budgets b ON b.token = u.token "
+                "WHERE u.day = ? GROUP BY u.token ORDER BY day_tokens DESC LIMIT ?",
+                (day, top)
+            ).fetchall()
+        return models, [(token, day_tokens, total, budget or self.session_budget)
+                        for token, day_tokens, total, budget in sessions]
+
+    def evict(self):
+        """
+        Delete per-session usage older than retention_days, and budget overrides set before then whose
+        session has no usage left. Overrides set for a session that has not made a call yet are kept.
+        """
+        self._last_evicted = time.time()
+        if not self.retention_days:
+            return
+        cutoff = time.time() - self.retention_days * 24 * 3600
+        with self._lock:
+            self._conn.execute("DELETE FROM session_usage WHERE day < ?", (time.strftime("%Y-%m-%d", time.localtime(cutoff)),))
+            self._conn.execute(
+                "DELETE FROM session_budgets WHERE set_at < ? AND token NOT IN (SELECT token FROM session_usage)", (cutoff,)
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def open_token_ledger(settings, base_dir):
+    """
+    Open the token ledger configured in settings.yaml.
+
+    Parameters:
+    - settings (dict): Contents of settings.yaml.
+    - base_dir (str): Directory that a relative token_ledger_path is resolved against.
+
+    Returns:
+    - TokenLedger: The ledger.
+    """
+    return TokenLedger(
+        os.path.join(base_dir, settings.get('token_ledger_path', 'token_ledger.sqlite3')),
+        session_budget=settings.get('token_budget_per_session', 200000),
+        daily_budget=settings.get('token_budget_per_day', 5000000),
+        compress_at=settings.get('budget_compress_at', 0.5),
+        shorten_at=settings.get('budget_shorten_at', 0.75),
+        downgrade_at=settings.get('budget_downgrade_at', 0.9),
+        retention_days=settings.get('token_ledger_retention_days', 90)
+    )
+
+
+def main():
+    from utils import get_src_dir, load_yaml_settings
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--day", default=None, help="Day to report, as YYYY-MM-DD. Defaults to today.")
+    parser.add_argument("--top", type=int, default=20, help="Number of sessions to list.")
+    parser.add_argument("--set-budget", nargs=2, metavar=("SESSION", "TOKENS"),
+                        help="Override the token budget of a session.")
+    args = parser.parse_args()
+
+    path = get_src_dir()
+    settings = load_yaml_settings(os.environ.get("RAPIDFIRE_SETTINGS", os.path.join(path, "settings.yaml")))
+    ledger = open_token_ledger(settings, path)
+    if args.set_budget:
+        session, tokens = args.set_budget
+        ledger.set_budget(session, int(tokens))
+        print(f"Budget of {session} set to {int(tokens):,} tokens")
+        return
+
+    day = args.day or ledger.today()
+    models, sessions = ledger.report(day, args.top)
+    daily_budget = f"{ledger.daily_budget:,}" if ledger.daily_budget else "unlimited"
+    print(f"Usage on {day} (daily budget {daily_budget} tokens)")
+    for model, prompt_tokens, completion_tokens, calls in models:
+        print(f"  {model:<20} {calls:>7,} calls  {prompt_tokens:>12,} prompt  {completion_tokens:>12,} completion")
+    if not models:
+        print("  no calls")
+    print("\nHeaviest sessions")
+    for token, day_tokens, total, budget in sessions:
+        limit = f"{total / budget:6.1%} of {budget:,}" if budget else "no budget"
+        print(f"  {token:<24} {day_tokens:>10,} that day  {total:>10,} in total ({limit})")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,24 @@
+import asyncio
 import os
 import inspect
-from langchain.llms.openai import OpenAIChat
-import yaml
-from fpdf import FPDF
+import collections
+import logging
+import queue
+import re
+import threading
+import time
+import weakref
+from concurrent.futures import Future, FIRST_COMPLETED, wait
+import importlib
 import io
-import yagmail
+import smtplib
+from email.message import EmailMessage
+from email.utils import make_msgid
+
+from metrics import METRICS
+from report_pdf import REPORT_RENDERER
+
+logger = logging.getLogger(__name__)
 
 def load_data(filename):
     with open(filename, 'r') as file:
@@ -14,11 +28,11 @@ def get_src_dir():
     """
     Returns the directory of the script that called this function.
     """
-    # Get the caller's stack frame
-    frame = inspect.stack()[1]
+    # Get the caller's stack frame (inspect.stack() would also read source lines for every frame)
+    frame = inspect.currentframe().f_back
     
     # Extract the path from the frame
-    path = frame[0].f_globals['__file__']
+    path = frame.f_globals['__file__']
     
     return os.path.dirname(os.path.abspath(path))
 
@@ -49,11 +63,503 @@ def save_string_to_file(content, filename):
     with open(filename, 'w') as file:
         file.write(content)
 
-def load_LLM(key):
-    """Logic for loading the chain you want to use should go here."""
-    # Make sure your openai_api_key is set as an environment variable
-    llm = OpenAIChat(temperature=.2, openai_api_key=key, model="gpt-4")
-    return llm
+class ChatPrompt(collections.namedtuple("ChatPrompt", ["system", "messages"])):
+    """
+    Prompt for a chat model: a fixed system message (the module's preamble) followed by
+    (role, content) messages. The preamble always comes first and unchanged, so the API can
+    reuse its cached prompt prefix across calls and sessions. Prompts are hashable, so they can
+    key caches and coalesce identical calls, and str() flattens one to plain text.
+    """
+    __slots__ = ()
+
+    def to_messages(self):
+        """Return the prompt as chat completion messages."""
+        messages = [{"role": "system", "content": self.system}] if self.system else []
+        return messages + [{"role": role, "content": content} for role, content in self.messages]
+
+    def __str__(self):
+        return "\n\n".join(part for part in [self.system] + [content for _, content in self.messages] if part)
+
+def chat_messages(prompt):
+    """Return chat completion messages for a ChatPrompt, or for a plain string sent as one user message."""
+    if isinstance(prompt, ChatPrompt):
+        return prompt.to_messages()
+    return [{"role": "user", "content": prompt}]
+
+class ChatPromptTemplate:
+    """
+    Template for a single-turn ChatPrompt. The paragraphs before the first one with a {field} are
+    the fixed system message and the rest is filled into the user message, so str() of a formatted
+    prompt is the same text as formatting the whole template.
+    """
+
+    def __init__(self, template):
+        paragraphs = template.split("\n\n")
+        first_field = next((i for i, paragraph in enumerate(paragraphs) if "{" in paragraph), len(paragraphs))
+        self.system = "\n\n".join(paragraphs[:first_field])
+        self.user = "\n\n".join(paragraphs[first_field:])
+
+    def format(self, **values):
+        return ChatPrompt(self.system, (("user", self.user.format(**values)),))
+
+_http_pool_lock = threading.Lock()
+
+def _install_http_pool(pool_size):
+    """Make every sync OpenAI call of the process share one pool of keep-alive connections."""
+    import openai
+    if openai.requestssession is not None:
+        return
+    with _http_pool_lock:
+        if openai.requestssession is not None:
+            return
+        import requests
+
+        class SharedSession(requests.Session):
+            def close(self):
+                pass  # openai closes its session every few minutes; this one is shared by all threads
+
+        session = SharedSession()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        # Otherwise openai opens a new session (and TLS connection) on every thread, and the
+        # background calls run on short-lived threads
+        openai.requestssession = session
+
+class ChatClient:
+    """
+    Client for the OpenAI chat completions API with sync (`client(prompt)`, `client.stream(prompt)`)
+    and async (`await client.acall(prompt)`, `client.astream(prompt)`) interfaces.
+
+    Prompts are ChatPrompts, or plain strings sent as a single user message. Sync calls from every
+    thread share one pool of keep-alive connections; async calls share one aiohttp session per
+    event loop. openai is imported on the first call, as it is slow to import.
+    """
+
+    def __init__(self, key, model="gpt-4", api_base=None, temperature=0.2, request_timeout=120, pool_size=32):
+        """
+        Parameters:
+        - key (str): OpenAI API key.
+        - model (str): Chat model name.
+        - api_base (str): Another OpenAI-compatible server (e.g. the benchmark mock). Defaults to OpenAI's.
+        - temperature (float): Sampling temperature.
+        - request_timeout (float): Seconds before a request is abandoned.
+        - pool_size (int): Maximum number of kept-alive connections.
+        """
+        self.model_name = model
+        self.pool_size = pool_size
+        self._params = {"api_key": key, "model": model, "temperature": temperature, "request_timeout": request_timeout}
+        if api_base:
+            self._params["api_base"] = api_base
+        self._aio_sessions = weakref.WeakKeyDictionary()  # event loop -> aiohttp session
+
+    def _create(self, prompt, **kwargs):
+        import openai
+        _install_http_pool(self.pool_size)
+        return openai.ChatCompletion.create(messages=chat_messages(prompt), **self._params, **kwargs)
+
+    @staticmethod
+    def _delta(chunk):
+        return chunk["choices"][0]["delta"].get("content") if chunk["choices"] else None
+
+    def __call__(self, prompt):
+        return self._create(prompt)["choices"][0]["message"]["content"]
+
+    def stream(self, prompt):
+        """Yield the response to a prompt in chunks as it is generated."""
+        for chunk in self._create(prompt, stream=True):
+            content = self._delta(chunk)
+            if content:
+                yield content
+
+    def _aiohttp_session(self):
+        import aiohttp
+        loop = asyncio.get_running_loop()
+        session = self._aio_sessions.get(loop)
+        if session is None or session.closed:
+            session = self._aio_sessions[loop] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60))
+        return session
+
+    async def _acreate(self, prompt, **kwargs):
+        import openai
+        token = openai.aiosession.set(self._aiohttp_session())
+        try:
+            return await openai.ChatCompletion.acreate(messages=chat_messages(prompt), **self._params, **kwargs)
+        finally:
+            openai.aiosession.reset(token)
+
+    async def acall(self, prompt):
+        """Return the response to a prompt."""
+        return (await self._acreate(prompt))["choices"][0]["message"]["content"]
+
+    async def astream(self, prompt):
+        """Yield the response to a prompt in chunks as it is generated."""
+        async for chunk in await self._acreate(prompt, stream=True):
+            content = self._delta(chunk)
+            if content:
+                yield content
+
+    async def aclose(self):
+        """Close the connections of the async interface for the running event loop."""
+        session = self._aio_sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+class StubChatClient:
+    """
+    Local stand-in for ChatClient, for tests and offline runs: no network, no API key. Every prompt
+    is answered by `respond`, after an optional delay, and the messages sent are kept in `calls`.
+    """
+
+    def __init__(self, model="stub", respond=None, delay=0.0):
+        """
+        Parameters:
+        - model (str): Model name to report.
+        - respond (callable): Function taking the list of chat messages and returning the response.
+          Defaults to a short canned reply.
+        - delay (float): Seconds to wait before responding.
+        """
+        self.model_name = model
+        self.calls = []
+        self._respond = respond or (lambda messages: f"(stub reply from {model} to: {messages[-1]['content'][:80]})")
+        self.delay = delay
+
+    def _response(self, prompt):
+        messages = chat_messages(prompt)
+        self.calls.append(messages)
+        return self._respond(messages)
+
+    def __call__(self, prompt):
+        time.sleep(self.delay)
+        return self._response(prompt)
+
+    def stream(self, prompt):
+        time.sleep(self.delay)
+        for word in self._response(prompt).split(" "):
+            yield word + " "
+
+    async def acall(self, prompt):
+        await asyncio.sleep(self.delay)
+        return self._response(prompt)
+
+    async def astream(self, prompt):
+        await asyncio.sleep(self.delay)
+        for word in self._response(prompt).split(" "):
+            yield word + " "
+
+    async def aclose(self):
+        pass
+
+def load_LLM(key, model="gpt-4", api_base=None, client="openai"):
+    """
+    Return the chat client for a model.
+
+    Parameters:
+    - key (str): OpenAI API key.
+    - model (str): Chat model name.
+    - api_base (str): Another OpenAI-compatible server (e.g. the benchmark mock).
+    - client (str): "openai" for the OpenAI API, "stub" for a StubChatClient that answers locally.
+    """
+    # Retries are handled by the LLMGateway, which backs off across all sessions at once
+    if client == "stub":
+        return StubChatClient(model)
+    if client != "openai":
+        raise ValueError(f"Unknown LLM client {client!r}, expected 'openai' or 'stub'")
+    return ChatClient(key, model=model, api_base=api_base)
+
+def warm_up(modules):
+    """
+    Import modules ahead of first use, e.g. on a background thread after the first page has been
+    shown. Failures are logged and otherwise ignored; the real use retries.
+
+    Parameters:
+    - modules (list): Names of modules to import.
+    """
+    started = time.perf_counter()
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            logger.exception("Warm-up import of %s failed", name)
+    METRICS.observe("warm_up", time.perf_counter() - started)
+
+def run_in_thread(fn):
+    """
+    Run fn on a new daemon thread and return a Future for its result.
+    """
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+def run_concurrently(*fns):
+    """
+    Call each function on its own thread and return their results in order.
+
+    Parameters:
+    - fns (callable): Functions taking no arguments.
+
+    Returns:
+    - list: The functions' results. The first exception raised by any of them is re-raised.
+    """
+    futures = [run_in_thread(fn) for fn in fns]
+    return [future.result() for future in futures]
+
+def merge_streams(streams):
+    """
+    Consume several LLM streams concurrently and interleave their progress.
+
+    Parameters:
+    - streams (dict): Maps a name to a function that opens an iterator of text chunks.
+
+    Yields:
+    - tuple: (name, text accumulated so far for that stream), once per received chunk.
+    """
+    chunks = queue.Queue()
+
+    def pump(name, open_stream):
+        try:
+            for chunk in open_stream():
+                chunks.put((name, chunk, None))
+        except Exception as e:
+            chunks.put((name, None, e))
+        else:
+            chunks.put((name, None, None))
+
+    for name, open_stream in streams.items():
+        threading.Thread(target=pump, args=(name, open_stream), daemon=True).start()
+
+    texts = {name: "" for name in streams}
+    running = len(streams)
+    while running:
+        name, chunk, error = chunks.get()
+        if error is not None:
+            raise error
+        if chunk is None:
+            running -= 1
+            continue
+        texts[name] += chunk
+        yield name, texts[name]
+
+class LatencyPolicy:
+    """
+    Deadline, hedging and fallback policy for slow LLM calls.
+
+    A call that has not finished after `hedge_after` seconds gets a duplicate "hedge" request,
+    and whichever of the two finishes first wins. If neither has finished after `deadline`
+    seconds, the fallback (e.g. a faster model) is used instead. For streams, both thresholds
+    apply to the first token. The path that won each call is counted in `wins`, with its
+    latency in `latencies`, so the thresholds can be tuned.
+    """
+
+    def __init__(self, name, hedge_after=None, deadline=None, max_samples=1000):
+        """
+        Parameters:
+        - name (str): Name used in logs, e.g. "blocking" or "stream".
+        - hedge_after (float): Seconds before a hedge request is sent. None disables hedging.
+        - deadline (float): Seconds before falling back. None waits indefinitely.
+        - max_samples (int): Number of recent latencies kept per path.
+        """
+        self.name = name
+        self.hedge_after = hedge_after
+        self.deadline = deadline
+        self.wins = collections.Counter()
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=max_samples))
+        self._lock = threading.Lock()
+
+    def _record(self, path, started):
+        latency = time.monotonic() - started
+        with self._lock:
+            self.wins[path] += 1
+            self.latencies[path].append(latency)
+        METRICS.inc("llm_policy_wins", policy=self.name, path=path)
+        logger.info("%s LLM call won by %s after %.2fs", self.name, path, latency)
+
+    def summary(self):
+        """
+        Return how often each path won and its p50/p95 latency in seconds, for tuning the thresholds.
+        """
+        with self._lock:
+            samples = {path: sorted(latencies) for path, latencies in self.latencies.items()}
+            wins = dict(self.wins)
+        return {
+            path: {
+                "wins": wins[path],
+                "p50": latencies[len(latencies) // 2],
+                "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            }
+            for path, latencies in samples.items() if latencies
+        }
+
+    def _next_timeout(self, started, hedged):
+        elapsed = time.monotonic() - started
+        limits = [limit - elapsed for limit, active in ((self.hedge_after, not hedged), (self.deadline, True))
+                  if limit is not None and active]
+        return max(0.0, min(limits)) if limits else None
+
+    def call(self, attempt, fallback=None):
+        """
+        Run a call under the policy.
+
+        Parameters:
+        - attempt (callable): Makes one request and returns the response. It may run more than once.
+        - fallback (callable): Used when the deadline expires. Without one, TimeoutError is raised.
+
+        Returns:
+        - The response of whichever path finished first.
+        """
+        started = time.monotonic()
+        pending = {run_in_thread(attempt): "primary"}
+        hedged = self.hedge_after is None
+        first_error = None
+
+        while pending:
+            done, _ = wait(pending, timeout=self._next_timeout(started, hedged), return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    first_error = first_error or e
+                    continue
+                self._record(path, started)
+                return response
+            if done:
+                continue
+
+            elapsed = time.monotonic() - started
+            if not hedged and elapsed >= self.hedge_after:
+                pending[run_in_thread(attempt)] = "hedge"
+                hedged = True
+            elif self.deadline is not None and elapsed >= self.deadline:
+                break
+
+        # Every request failed: let the caller decide whether to retry
+        if not pending:
+            raise first_error
+
+        if fallback is None:
+            raise TimeoutError(f"LLM call did not finish within {self.deadline}s")
+        response = fallback()
+        self._record("fallback", started)
+        return response
+
+    def stream(self, open_stream, open_fallback=None):
+        """
+        Stream a call under the policy, racing hedges and falling back on the first token.
+
+        Parameters:
+        - open_stream (callable): Returns an iterator of response chunks. It may run more than once.
+        - open_fallback (callable): Returns the fallback iterator, used when no first token arrives before the deadline.
+
+        Yields:
+        - str: Chunks from whichever stream produced a token first.
+        """
+        started = time.monotonic()
+        chunks = queue.Queue()
+        stops = {}
+
+        def start(path, open_path):
+            stop = stops[path] = threading.Event()
+
+            def pump():
+                try:
+                    for chunk in open_path():
+                        if stop.is_set():
+                            break
+                        chunks.put((path, "chunk", chunk))
+                    chunks.put((path, "end", None))
+                except Exception as e:
+                    chunks.put((path, "error", e))
+
+            threading.Thread(target=pump, daemon=True).start()
+
+        start("primary", open_stream)
+        hedged = self.hedge_after is None
+        running = 1
+        first_error = None
+        winner = None
+
+        try:
+            while winner is None:
+                try:
+                    path, kind, value = chunks.get(timeout=self._next_timeout(started, hedged))
+                except queue.Empty:
+                    elapsed = time.monotonic() - started
+                    if not hedged and elapsed >= self.hedge_after:
+                        start("hedge", open_stream)
+                        hedged = True
+                        running += 1
+                        continue
+                    if open_fallback is None:
+                        raise TimeoutError(f"LLM stream produced no token within {self.deadline}s")
+                    start("fallback", open_fallback)
+                    winner = "fallback"
+                    self._record(winner, started)
+                    break
+
+                if kind == "error":
+                    first_error = first_error or value
+                    running -= 1
+                    if not running:
+                        raise first_error
+                    continue
+
+                winner = path
+                self._record(path, started)
+                if kind == "chunk":
+                    yield value
+                else:
+                    return
+
+            for path, kind, value in iter(chunks.get, None):
+                if path != winner:
+                    continue
+                if kind == "chunk":
+                    yield value
+                elif kind == "end":
+                    return
+                else:
+                    raise value
+        finally:
+            for stop in stops.values():
+                stop.set()
+
+# Pre-tokenization close to OpenAI's cl100k encoding: contractions, words with their leading
+# space, numbers in groups of up to three digits, punctuation runs and whitespace. Common words
+# are a single token; longer words are split into pieces of about five characters.
+_PIECES = re.compile(r"'(?:s|t|re|ve|m|ll|d)\b| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+")
+
+def count_tokens(text):
+    """
+    Count the tokens in a string or ChatPrompt with a fast local approximation of the OpenAI tokenizer
+    (typically within 10% for English prose, about 1 ms for 10 KB of text).
+    """
+    pieces = _PIECES.findall(str(text))
+    return len(pieces) + sum((len(piece) - 4) // 5 for piece in pieces if len(piece) > 8)
+
+def stream_llm(llm, prompt):
+    """
+    Stream the LLM's response to a prompt as it is generated.
+
+    Parameters:
+    - llm: Client returned by load_LLM, or an LLMGateway.
+    - prompt (str or ChatPrompt): The prompt to send.
+
+    Yields:
+    - str: The response accumulated so far, once per received token.
+    """
+    response = ""
+    for chunk in llm.stream(prompt):
+        response += chunk
+        yield response
 
 def load_file_to_list(filename):
     """
@@ -79,40 +585,82 @@ def load_yaml_settings(filename):
     Returns:
     - dict: Dictionary containing the contents of the YAML file.
     """
+    import yaml
     with open(filename, 'r') as file:
         return yaml.load(file, Loader=yaml.FullLoader)
 
 def create_pdf(text):
     """
-    Create a PDF document from a given string.
-    """
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_font("Arial", size=12)
-    pdf.multi_cell(0, 10, txt=text)
-
-    # Save to a BytesIO object and return that
-    pdf_buffer = io.BytesIO()
-    pdf.output(pdf_buffer, "F")
-    pdf_buffer.seek(0)
-    return pdf_buffer
-
-import yagmail
-import tempfile
-
-def send_email_with_pdf(student_name, sender_email, recipient_email, subject, content, pdf_buffer, email_password):
-    temp_filename = f"{student_name}_counseling_report.pdf"
-    with open(temp_filename, "wb") as f:
-        f.write(pdf_buffer.getvalue())
-
-    # Create yagmail client using the sender email and the provided email password
-    yag = yagmail.SMTP(sender_email, email_password)
-    yag.send(
-        to=recipient_email,
-        subject=subject,
-        contents=content,
-        attachments=[temp_filename]  # Pass the temp file path as the attachment
-    )
-    
-    # Optionally delete the temp file if you don't want to keep it
-    # os.remove(temp_filename)
+    Create a PDF document from a report, laid out from its headings and outline.
+    Identical reports are rendered once and then served from REPORT_RENDERER's cache.
+    """
+    return io.BytesIO(REPORT_RENDERER.render(text))
+
+def create_digest_pdf(title, reports):
+    """
+    Create one PDF from several reports: an index page listing them, then each report on its own pages.
+
+    Parameters:
+    - title (str): Heading of the index page.
+    - reports (list): (heading, text) tuples, in index order.
+
+    Returns:
+    - io.BytesIO: The PDF.
+    """
+    return io.BytesIO(REPORT_RENDERER.render_many(title, reports))
+
+def build_email_with_pdf(student_name, sender_email, recipient_email, subject, content, pdf_buffer):
+    """
+    Build an email with the report attached straight from memory.
+
+    Parameters:
+    - student_name (str): Used to name the attachment.
+    - sender_email (str): From address.
+    - recipient_email (str): To address.
+    - subject (str): Subject line.
+    - content (str): Plain text body.
+    - pdf_buffer (io.BytesIO): The PDF to attach.
+
+    Returns:
+    - EmailMessage: The message, ready to be sent or serialized.
+    """
+    message = EmailMessage()
+    message["From"] = sender_email
+    message["To"] = recipient_email
+    message["Subject"] = subject
+    message["Message-ID"] = make_msgid()
+    message.set_content(inspect.cleandoc(content))
+    message.add_attachment(pdf_buffer.getvalue(), maintype="application", subtype="pdf",
+                           filename=f"{student_name}_counseling_report.pdf")
+    return message
+
+def open_smtp_connection(sender_email, email_password, host="smtp.gmail.com", port=465, use_ssl=True):
+    """
+    Open and log in to an SMTP connection that can be reused for several messages.
+
+    Parameters:
+    - sender_email (str): Account to log in as.
+    - email_password (str): Password for the account. If empty, no login is attempted (e.g. a local test server).
+    - host (str), port (int), use_ssl (bool): SMTP server to connect to.
+
+    Returns:
+    - smtplib.SMTP: The open connection.
+    """
+    smtp = smtplib.SMTP_SSL(host, port) if use_ssl else smtplib.SMTP(host, port)
+    if email_password:
+        smtp.login(sender_email, email_password)
+    return smtp
+
+@METRICS.timed("send_email", via="direct")
+def send_email_with_pdf(student_name, sender_email, recipient_email, subject, content, pdf_buffer, email_password,
+                        host="smtp.gmail.com", port=465, use_ssl=True):
+    """
+    Send a report email synchronously over a new connection. The app sends through the
+    EmailOutbox instead; this is kept for scripts and one-off sends.
+    """
+    message = build_email_with_pdf(student_name, sender_email, recipient_email, subject, content, pdf_buffer)
+    smtp = open_smtp_connection(sender_email, email_password, host, port, use_ssl)
+    try:
+        smtp.send_message(message)
+    finally:
+        smtp.quit()
@@ -0,0 +1,124 @@
+"""
+Pre-generate Module 1 essays into the essay cache so students are served from local storage.
+
+Every combination of strong attribute, identity, wildcard and common prompt from prompts/*.txt
+is rendered with module_one_strong.txt (and every weak attribute combination with
+module_one_weak.txt) and generated until the cache holds the configured number of variants for it.
+
+Usage:
+    python warm_cache.py --limit 500 --concurrency 4 --rpm 60
+"""
+import argparse
+import itertools
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, exists
+
+from utils import ChatPromptTemplate, load_data, get_src_dir, load_api_key_from_file, load_LLM, load_file_to_list, load_yaml_settings
+from essay_cache import open_essay_cache
+from gateway import LLMGateway
+
+PATH = get_src_dir()
+pathToPrompts = join(PATH, "prompts")
+
+
+def iter_module_one_prompts(part):
+    """
+    Yield every rendered Module 1 prompt for one essay part ("strong" or "weak") and the attribute lists in prompts/.
+    """
+    module_one_prompt = ChatPromptTemplate(load_data(join(pathToPrompts, f"module_one_{part}.txt")))
+    lists = [load_file_to_list(join(pathToPrompts, name)) for name in (
+        f"{part}_attributes.txt", "identity.txt", "wildcard.txt", "common_questions.txt")]
+    for attribute, identity, wildcard, common in itertools.product(*lists):
+        yield module_one_prompt.format(
+            identity=identity,
+            wildcard=wildcard,
+            common_essay_prompt=common,
+            **{f"{part}_attribute": attribute}
+        )
+
+
+def load_api_key(api_key):
+    if api_key:
+        return api_key
+    key_path = join(PATH, "config.txt")
+    if exists(key_path):
+        return load_api_key_from_file(key_path).get('API_KEY')
+    return os.environ.get("OPENAI_API_KEY")
+
+
+def main():
+    settings = load_yaml_settings(join(PATH, "settings.yaml"))
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--variants", type=int, default=settings.get('essay_cache_variants', 3),
+                        help="Number of outputs to store for each prompt.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Maximum number of LLM calls in flight.")
+    parser.add_argument("--rpm", type=float, default=60, help="Maximum number of LLM calls started per minute, per model.")
+    parser.add_argument("--tpm", type=float, default=settings.get('llm_tokens_per_minute', 40000),
+                        help="Maximum number of prompt and completion tokens per minute, per model.")
+    parser.add_argument("--limit", type=int, default=None, help="Stop after this many LLM calls.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the order prompts are warmed in.")
+    parser.add_argument("--api-key", default=None, help="OpenAI API key. Defaults to config.txt, then OPENAI_API_KEY.")
+    args = parser.parse_args()
+
+    api_key = load_api_key(args.api_key)
+    if not api_key:
+        parser.error("No API key found in --api-key, config.txt or OPENAI_API_KEY.")
+
+    llm_model = settings.get('llm_model', 'gpt-4')
+    models = {
+        "strong": settings.get('module_one_strong_model', llm_model),
+        "weak": settings.get('module_one_weak_model', llm_model),
+    }
+    gateways = {}
+    for model in set(models.values()):
+        gateways[model] = LLMGateway(load_LLM(api_key, model=model), requests_per_minute=args.rpm,
+                                     tokens_per_minute=args.tpm, max_retries=settings.get('llm_max_retries', 5))
+    essay_cache = open_essay_cache(settings, PATH)
+    essay_cache.variants_per_prompt = max(essay_cache.variants_per_prompt, args.variants)
+
+    # Warm in random order so a partial run still covers the whole input space evenly
+    prompts = [(part, prompt) for part in models for prompt in iter_module_one_prompts(part)]
+    random.Random(args.seed).shuffle(prompts)
+
+    slots = threading.BoundedSemaphore(args.concurrency)
+    counts = {"generated": 0, "failed": 0}
+    counts_lock = threading.Lock()
+
+    def generate(part, prompt):
+        try:
+            # Variants of one prompt must be generated independently, not coalesced
+            essay_cache.put(prompt, gateways[models[part]](prompt, coalesce=False).strip())
+            with counts_lock:
+                counts["generated"] += 1
+        except Exception as e:
+            with counts_lock:
+                counts["failed"] += 1
+            print(f"Generation failed: {e}")
+        finally:
+            slots.release()
+
+    submitted = 0
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for part, prompt in prompts:
+            missing = args.variants - essay_cache.variant_count(prompt)
+            for _ in range(missing):
+                if args.limit is not None and submitted >= args.limit:
+                    break
+                slots.acquire()
+                executor.submit(generate, part, prompt)
+                submitted += 1
+            if args.limit is not None and submitted >= args.limit:
+                break
+
+    print(f"Generated {counts['generated']} outputs ({counts['failed']} failed) for "
+          f"{len(prompts)} prompts in {time.monotonic() - start:.1f}s.")
+
+
+if __name__ == "__main__":
+    main()